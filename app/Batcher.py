@@ -0,0 +1,56 @@
+import asyncio
+
+
+class Batcher:
+    """Coalesce concurrent calls into batches, sent once `size` items are pending or after `wait` seconds.
+
+    `submit` returns once the batch holding its item was sent, with the
+    result `send` settled for it, or raises what it failed with, so every
+    caller still sees the outcome of its own item. Subclasses implement
+    `send(batch)` for a list of `(item, future)` and settle the futures.
+    """
+
+    def __init__(self, size: int, wait: float):
+        self.size = size
+        self.wait = wait
+        self.pending = []       # (item, future) waiting for the next flush
+        self.timer = None
+        self.sends = set()      # running send tasks
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.wait, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self.run(batch))
+            self.sends.add(task)
+            task.add_done_callback(self.sends.discard)
+
+    async def run(self, batch: list):
+        try:
+            await self.send(batch)
+        except Exception as exc:
+            self.settle(batch, exc=exc)
+
+    async def send(self, batch: list):
+        raise NotImplementedError
+
+    @staticmethod
+    def settle(batch: list, result=None, exc: Exception = None):
+        for _, future in batch:
+            if future.done():
+                continue
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
@@ -1,4 +1,5 @@
 import os
+import asyncio
 from datetime import datetime
 from functools import wraps
 import ujson
@@ -9,7 +10,12 @@ from helium_py.crypto.keypair import Keypair
 from helium_py.crypto.keypair import SodiumKeyPair
 
 from protos.helium import iot_config
+from Batcher import Batcher
+from grpclib import GRPCError
 from grpclib.client import Channel
+from grpclib.config import Configuration
+from grpclib.const import Status
+from grpclib.exceptions import StreamTerminatedError
 
 # precision for signing rpc's moving from milliseconds to seconds in next iot config update
 # quick helper function to switch it over quickly when updated.
@@ -20,6 +26,14 @@ port = int(os.getenv("HELIUM_PORT", default=6080))
 oui = int(os.getenv("HELIUM_OUI", default=None))
 route_id = os.getenv('ROUTE_ID', None)
 delegate_key = os.getenv('HELIUM_KEYPAIR_BIN', default=None)
+# deadline in seconds for each config service call, keepalive pings detect a dead connection.
+helium_timeout = float(os.getenv('HELIUM_GRPC_TIMEOUT', 30))
+helium_keepalive = float(os.getenv('HELIUM_GRPC_KEEPALIVE', 30))
+# eui updates are streamed together for up to `eui_batch_wait` seconds or `eui_batch_size` updates.
+eui_batch_size = int(os.getenv('HELIUM_EUI_BATCH_SIZE', 500))
+eui_batch_wait = float(os.getenv('HELIUM_EUI_BATCH_WAIT', 0.1))
+# a replaced channel is closed once the longest call deadline, a skf listing, has passed.
+retire_grace = helium_timeout * 10 + 5
 
 with open(delegate_key, 'rb') as f:
     blob = f.read()[:65]
@@ -69,6 +83,135 @@ def rpc_time(precision: str = None):
         return int(datetime.utcnow().timestamp())
 
 
+def signed(req):
+    """Stamp and sign a config service request, in place."""
+    req.timestamp = rpc_time(PRECISION)
+    req.signer = delegate_keypair.address.bin
+    req.signature = delegate_keypair.sign(req.SerializeToString())
+    return req
+
+
+class HeliumChannel:
+    """One grpclib channel to the helium config service, shared by every `RouteStub` call.
+
+    Opened on first use. grpclib reconnects a channel whose connection was
+    lost on its next call, keepalive pings make sure a silently dropped
+    connection is noticed, see `route_call` for the retry. A channel a
+    call failed on is retired rather than closed, calls still on it run
+    to their deadline before it is closed.
+    """
+
+    def __init__(self):
+        self.channel = None
+        self.stub = None
+        self.retired = set()    # channels replaced after a failed call, closed after `retire_grace`
+
+    def route(self) -> iot_config.RouteStub:
+        if self.channel is None:
+            config = Configuration(
+                _keepalive_time=helium_keepalive,
+                _keepalive_timeout=10,
+                _keepalive_permit_without_calls=True,
+                _http2_max_pings_without_data=0,
+            )
+            self.channel = Channel(host, port, config=config)
+            self.stub = iot_config.RouteStub(self.channel, timeout=helium_timeout)
+        return self.stub
+
+    def retire(self, stub: iot_config.RouteStub):
+        """Replace the channel `stub` is on, if no other failed call replaced it already."""
+        if stub is not self.stub:
+            return
+        channel = self.channel
+        self.channel = None
+        self.stub = None
+        self.retired.add(channel)
+        asyncio.get_running_loop().call_later(retire_grace, self.close_retired, channel)
+
+    def close_retired(self, channel: Channel):
+        if channel in self.retired:
+            self.retired.discard(channel)
+            channel.close()
+
+    def close(self):
+        for channel in self.retired:
+            channel.close()
+        self.retired.clear()
+        if self.channel is not None:
+            self.channel.close()
+        self.channel = None
+        self.stub = None
+
+
+helium_channel = HeliumChannel()
+
+
+async def route_call(call):
+    """`await call(route_stub)` on the shared channel, retried once on a new connection if it failed.
+
+    `call` builds and signs its request itself, so a retry is signed with a
+    fresh timestamp.
+    """
+    stub = helium_channel.route()
+    try:
+        return await call(stub)
+    except GRPCError as err:
+        if err.status != Status.UNAVAILABLE:
+            raise
+        logging.info(f'helium config service: {err.status.name}, reconnecting')
+    except (OSError, StreamTerminatedError) as err:
+        logging.info(f'helium config service: {err!r}, reconnecting')
+    # other calls in flight on the failed channel are left to finish or fail on their own.
+    helium_channel.retire(stub)
+    return await call(helium_channel.route())
+
+
+class EuiBatcher(Batcher):
+    """Stream concurrent eui updates to the config service as one `update_euis` call.
+
+    `update` waits for the call carrying its update and returns its
+    response, or raises what it raised, so each caller still sees the
+    result of its own update. A batch that fails is resent one update at
+    a time, so one rejected pair only fails its own caller. Batches are
+    sent one after the other in the order they were flushed.
+    """
+
+    def __init__(self):
+        super().__init__(eui_batch_size, eui_batch_wait)
+        self.lock = asyncio.Lock()  # one batch on the wire at a time, waiters are served in flush order
+
+    async def update(self, action: int, eui_pair: iot_config.EuiPairV1) -> iot_config.RouteEuisResV1:
+        return await self.submit((action, eui_pair))
+
+    async def stream(self, batch: list) -> iot_config.RouteEuisResV1:
+        def requests():
+            for (action, eui_pair), _ in batch:
+                yield signed(iot_config.RouteUpdateEuisReqV1(action=iot_config.ActionV1(action), eui_pair=eui_pair))
+
+        return await route_call(lambda service: service.update_euis(list(requests())))
+
+    async def send(self, batch: list):
+        async with self.lock:
+            try:
+                resp = await self.stream(batch)
+            except Exception as exc:
+                if len(batch) == 1:
+                    self.settle(batch, exc=exc)
+                    return
+                logging.info(f'update_euis: batch of {len(batch)} failed ({exc!r}), resending one by one')
+                for entry in batch:
+                    try:
+                        self.settle([entry], await self.stream([entry]))
+                    except Exception as err:
+                        self.settle([entry], exc=err)
+                return
+            logging.info(f'update_euis: streamed {len(batch)} updates')
+            self.settle(batch, resp)
+
+
+eui_batcher = EuiBatcher()
+
+
 ###########################################################################
 # Helium gRPC API calls
 ###########################################################################
@@ -77,44 +220,17 @@ async def sync_device_euis(action: bool, app_eui: str, dev_eui: str, route_id: s
     app_eui = int(app_eui, 16)
     dev_eui = int(dev_eui, 16)
     print(f'dev_eui: {dev_eui}, app_eui: {app_eui}')
-    async with Channel(host, port) as channel:
-        service = iot_config.RouteStub(channel)
-        req = iot_config.RouteUpdateEuisReqV1(
-            action=iot_config.ActionV1(action),
-            eui_pair=iot_config.EuiPairV1(
-                route_id=route_id,
-                app_eui=app_eui,
-                dev_eui=dev_eui
-            ),
-            timestamp=rpc_time(PRECISION),
-            signer=delegate_keypair.address.bin
-        )
-        req.signature = delegate_keypair.sign(req.SerializeToString())
-        resp = await service.update_euis([req])
+    eui_pair = iot_config.EuiPairV1(
+        route_id=route_id,
+        app_eui=app_eui,
+        dev_eui=dev_eui
+    )
+    # streamed together with the other eui updates made around the same time.
+    resp = await eui_batcher.update(action, eui_pair)
     print(ujson.dumps(resp.to_dict(), indent=2))
     return
 
 
-@my_logger
-async def get_route_skfs() -> list[dict]:
-    async with Channel(host, port) as channel:
-        service = iot_config.RouteStub(channel)
-        req = iot_config.RouteSkfListReqV1(
-            route_id=route_id,
-            timestamp=rpc_time(PRECISION),
-            signer=delegate_keypair.address.bin
-        )
-        req.signature = delegate_keypair.sign(req.SerializeToString())
-        all_skfs = []
-        async for skfs in service.list_skfs(req):
-            device = skfs.to_dict()
-            device['devaddr'] = hex(device['devaddr'])[2:]
-            if 'maxCopies' not in device.keys():
-                device['maxCopies'] = 0
-            all_skfs.append(device)
-    return all_skfs
-
-
 @my_logger
 async def update_device_skfs(route_id: str, skfs_action: list):
     """ Example of device session key update.
@@ -129,8 +245,7 @@ async def update_device_skfs(route_id: str, skfs_action: list):
             ...
         ]
     """
-    async with Channel(host, port) as channel:
-        service = iot_config.RouteStub(channel)
+    async def call(service: iot_config.RouteStub):
         req = iot_config.RouteSkfUpdateReqV1(
             route_id=route_id,
             updates=skfs_action,
@@ -138,5 +253,7 @@ async def update_device_skfs(route_id: str, skfs_action: list):
             signer=delegate_keypair.address.bin
         )
         req.signature = delegate_keypair.sign(req.SerializeToString())
-        resp = await service.update_skfs(req)
+        return await service.update_skfs(req)
+
+    resp = await route_call(call)
     return ujson.dumps(resp.to_dict(), indent=2)
@@ -1,20 +1,18 @@
 import os
-import redis.asyncio as redis
-import grpc
+import asyncio
 from google.protobuf.json_format import MessageToJson, MessageToDict
-from chirpstack_api import api, integration
+from chirpstack_api import integration
 import logging
 
-from protos.helium import iot_config
 from ChirpHeliumCrypto import update_device_skfs
+from StreamDecoder import decode_join_event
+from ChirpstackClient import ChirpstackClient
+from HeliumDevices import DeviceWriter, merged_record
+from RouteSkf import Skf, session_updates
 
 
-# -----------------------------------------------------------------------------
-# CHIRPSTACK REDIS CONNECTION
-# -----------------------------------------------------------------------------
-redis_server = os.getenv('REDIS_HOST')
-rpool = redis.ConnectionPool(host=redis_server, port=6379, db=0)
-rdb = redis.Redis(connection_pool=rpool, decode_responses=True)
+# joined devices handled at once, their helium_devices upserts share one statement.
+join_concurrency = int(os.getenv('JOIN_CONCURRENCY', 100))
 
 
 class ChirpstackJoins:
@@ -22,13 +20,17 @@ class ChirpstackJoins:
         self,
         route_id: str,
         pool,
-        chirpstack_host: str,
-        chirpstack_token: str,
+        chirpstack: ChirpstackClient,
     ):
         self.route_id = route_id
         self.pool = pool
-        self.cs_grpc = chirpstack_host
-        self.auth_token = [("authorization", f"Bearer {chirpstack_token}")]
+        self.chirpstack = chirpstack
+        self.writer = DeviceWriter(pool)
+
+    async def db_fetch(self, query: str, *params):
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                return await con.fetch(query, *params)
 
     async def db_transaction(self, query: str, *params):
         async with self.pool.acquire() as con:
@@ -38,110 +40,107 @@ class ChirpstackJoins:
     ###########################################################################
     # follow internal redis stream gRPC for actionable changes
     ###########################################################################
-    async def device_stream_event(self):
-        stream_key = 'device:stream:event'
-        last_id = '0'
-        while True:
-            try:
-                resp = await rdb.xread({stream_key: last_id}, count=1, block=0)
-
-                for message in resp[0][1]:
-                    last_id = message[0]
+    def device_stream_event(self, dispatcher):
+        dispatcher.register(
+            'device:stream:event',
+            b'join',
+            self.handle_event,
+            partition=decode_join_event,
+            catch_up=self.catch_up_events,
+        )
 
-                    if b'join' in message[1]:
-                        msg = message[1][b'join']
-                        print('========== v DECODED EVENT JOIN DEVICE UP MESSAGE v ==========')
-                        pl = integration.integration_pb2.JoinEvent()
-                        pl.ParseFromString(msg)
-                        dev_eui = MessageToDict(pl)["deviceInfo"]["devEui"]
-                        print(dev_eui)
-                        # add session key for joined device
-                        await self.add_session_key(dev_eui)
-                        # add device session details to db
+    async def handle_event(self, messages: list, consumer: str) -> dict:
+        joins = {}
+        failed = {}
+        for message_id, join in messages:
+            print('========== v DECODED EVENT JOIN DEVICE UP MESSAGE v ==========')
+            try:
+                dev_eui = decode_join_event(join)
+            except Exception as err:
+                failed[message_id] = f'decode: {err}'
+                continue
+            print(dev_eui)
+            joins.setdefault(dev_eui, []).append(message_id)
+            print('========== ^ DECODED EVENT JOIN DEVICE UP MESSAGE ^ ==========')
+
+        # a device joining more than once in a batch only needs its latest session.
+        for dev_eui, err in (await self.add_session_keys(list(joins))).items():
+            logging.info(f'join {dev_eui}: {err!r}')
+            # the error itself, so the dispatcher can tell an outage from a bad entry.
+            failed.update((message_id, err) for message_id in joins[dev_eui])
+        return failed
+
+    async def add_session_keys(self, dev_euis: list[str]) -> dict:
+        """Add the session keys of joined devices, `join_concurrency` at a time, returns errors by dev_eui."""
+        errors = {}
+        for pos in range(0, len(dev_euis), join_concurrency):
+            group = dev_euis[pos:pos + join_concurrency]
+            for dev_eui in group:
+                # a join replaces the activation, the device record stays current.
+                self.chirpstack.activations.invalidate(dev_eui)
+            try:
+                previous = await self.previous_sessions(group)
+            except Exception as err:
+                errors.update((dev_eui, err) for dev_eui in group)
+                continue
+            results = await asyncio.gather(
+                *[self.add_session_key(dev_eui, previous.get(dev_eui)) for dev_eui in group],
+                return_exceptions=True)
+            errors.update(
+                (dev_eui, result) for dev_eui, result in zip(group, results) if isinstance(result, Exception))
+        return errors
+
+    async def previous_sessions(self, dev_euis: list[str]) -> dict[str, Skf]:
+        """Sessions helium_devices holds for `dev_euis`, the ones a join replaces."""
+        rows = await self.db_fetch(
+            "SELECT dev_eui, dev_addr, nws_key, max_copies FROM helium_devices WHERE dev_eui = ANY($1::text[]);",
+            dev_euis,
+        )
+        return {
+            row['dev_eui']: Skf.of_session(row['dev_addr'], row['nws_key'], row['max_copies'])
+            for row in rows
+        }
 
-                        print('========== ^ DECODED EVENT JOIN DEVICE UP MESSAGE ^ ==========')
+    async def catch_up_events(self, pages) -> dict:
+        """Backlog replay, only the latest session of each joined device is pushed.
 
-            except Exception as err:
-                logging.info(f'api_stream_requests: {err}')
-                pass
+        Returns the last join of each device that could not be applied, by message id.
+        """
+        joined = {}     # dev_eui -> id of its last join in the backlog
+        failed = {}
+        async for page in pages:
+            for message_id, join in page:
+                try:
+                    joined[decode_join_event(join)] = message_id
+                except Exception as err:
+                    failed[message_id] = f'decode: {err}'
+        print(f'Catch-up joins: {len(joined)} devices')
+        for dev_eui, err in (await self.add_session_keys(list(joined))).items():
+            # the sweep would only repair it hours later, the device's last join is dead-lettered.
+            logging.info(f'catch_up_events {dev_eui}: {err!r}')
+            failed[joined[dev_eui]] = err
+        return failed
 
     async def get_device(self, dev_eui: str) -> dict[str]:
-        async with grpc.aio.insecure_channel(self.cs_grpc) as channel:
-            client = api.DeviceServiceStub(channel)
-            req = api.GetDeviceRequest()
-            req.dev_eui = dev_eui
-            resp = await client.Get(req, metadata=self.auth_token)
-            data = MessageToDict(resp)["device"]
-        return data
+        resp = await self.chirpstack.get_device(dev_eui)
+        return MessageToDict(resp)["device"]
 
     async def get_device_activation(self, dev_eui: str):
-        async with grpc.aio.insecure_channel(self.cs_grpc) as channel:
-            client = api.DeviceServiceStub(channel)
-            req = api.GetDeviceActivationRequest()
-            req.dev_eui = dev_eui
-            resp = await client.GetActivation(req, metadata=self.auth_token)
-            data = MessageToDict(resp)['deviceActivation']
-            print('*** deviceActivation ***\n', data)
+        resp = await self.chirpstack.get_device_activation(dev_eui)
+        data = MessageToDict(resp)['deviceActivation']
+        print('*** deviceActivation ***\n', data)
         return data
 
-    async def add_session_key(self, dev_eui):
+    async def add_session_key(self, dev_eui, previous: Skf = None):
+        """Swap the previous session of a (re)joined device for its new one on the route."""
         device = await self.get_device(dev_eui)
         device_act = await self.get_device_activation(dev_eui)
+        record = merged_record(device, device_act)
 
-        dev_addr = device_act['devAddr']
-        nws_key = device_act['nwkSEncKey']
-        add_skfs = [
-            iot_config.RouteSkfUpdateReqV1RouteSkfUpdateV1(
-                devaddr=int(dev_addr, 16),
-                session_key=nws_key,
-                action=iot_config.ActionV1(0),
-                max_copies=0
-            )
-        ]
-        print('*** Adding Join Skfs ***\n', add_skfs)
-        await update_device_skfs(self.route_id, add_skfs)
-
-        devices = {
-            "devAddr": "",
-            "appSKey": "",
-            "nwkSEncKey": "",
-            "name": "",
-        }
+        skfs = session_updates(previous, Skf.of_session(record.dev_addr, record.nws_key, record.max_copies))
+        if skfs:
+            print('*** Updating Join Skfs ***\n', skfs)
+            await update_device_skfs(self.route_id, skfs)
 
-        devices.update(device)
-        devices.update(device_act)
-
-        max_copies = 0
-        if devices.get("variables") and "max_copies" in devices.get("variables"):
-            max_copies = int(devices["variables"]["max_copies"])
-        if "fCntUp" not in devices.keys():
-            devices["fCntUp"] = 0
-        if "nFCntDown" not in devices.keys():
-            devices["nFCntDown"] = 0
-
-        query = """
-            INSERT INTO helium_devices
-            (dev_eui, join_eui, dev_addr, max_copies, aps_key, nws_key, dev_name, fcnt_up, fcnt_down)
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-            ON CONFLICT (dev_eui) DO UPDATE
-            SET join_eui = EXCLUDED.join_eui,
-                dev_addr = EXCLUDED.dev_addr,
-                max_copies = EXCLUDED.max_copies,
-                aps_key = EXCLUDED.aps_key,
-                nws_key = EXCLUDED.nws_key,
-                dev_name = EXCLUDED.dev_name,
-                fcnt_up = EXCLUDED.fcnt_up,
-                fcnt_down = EXCLUDED.fcnt_down;
-        """
-        await self.db_transaction(
-            query,
-            devices["devEui"],
-            devices["joinEui"],
-            devices["devAddr"],
-            max_copies,
-            devices["appSKey"],
-            devices["nwkSEncKey"],
-            devices["name"],
-            devices["fCntUp"],
-            devices["nFCntDown"],
-        )
+        # batched with the other joins handled concurrently.
+        await self.writer.write(record)
@@ -1,10 +1,113 @@
-import grpc
+import os
+import time
+import asyncio
 from google.protobuf.json_format import MessageToDict
-from chirpstack_api import api
 import logging
 
-from ChirpHeliumCrypto import get_route_skfs, update_device_skfs
+from ChirpHeliumCrypto import update_device_skfs
 from protos.helium import iot_config
+from ChirpstackClient import ChirpstackClient
+from Metrics import incr
+from StreamDecoder import decode_device_session
+from HeliumDevices import DeviceRecord, DeviceWriter, merged_record, upsert_devices
+from RouteSkf import Skf
+from RouteMirror import copy_listing, skf_listing
+
+
+# devices synced at once by `update_device_status`, each one is two grpc calls and an upsert.
+device_sync_concurrency = int(os.getenv('DEVICE_SYNC_CONCURRENCY', 16))
+# 'grpc' looks every device up over the api, 'sql' reads chirpstack's device table (v4.7+) in one query,
+# 'list' finds changed devices from the paged List apis when chirpstack's db is not reachable.
+device_sync_mode = os.getenv('DEVICE_SYNC_MODE', 'grpc')
+# passes in between only sync devices changed since the last one, 0 makes every pass a full sync.
+device_full_sync_interval = int(os.getenv('DEVICE_FULL_SYNC_INTERVAL', 3600))
+# tenant listed in 'list' mode, all tenants when unset (needs an admin api key).
+chirpstack_tenant_id = os.getenv('CHIRPSTACK_TENANT_ID')
+# skf update chunks in flight at once, and attempts per chunk before it is given up on.
+skf_concurrency = int(os.getenv('HELIUM_SKF_CONCURRENCY', 4))
+skf_attempts = int(os.getenv('HELIUM_SKF_ATTEMPTS', 3))
+# devaddrs of the skf diff sent per window, and listed skfs copied to postgres at once.
+skf_diff_window = int(os.getenv('HELIUM_SKF_DIFF_WINDOW', 10_000))
+
+# enabled devices, or with $1 set only those updated since, (re)joined with another dev_addr,
+# not in helium_devices yet or listed in $2 (failed last pass).
+changed_devices = """
+    FROM device
+    LEFT JOIN helium_devices ON helium_devices.dev_eui = encode(device.dev_eui, 'hex')
+    WHERE device.is_disabled=false
+    AND (
+        $1::timestamptz IS NULL
+        OR device.updated_at > $1
+        OR helium_devices.dev_eui IS NULL
+        OR helium_devices.dev_addr IS DISTINCT FROM coalesce(encode(device.dev_addr, 'hex'), '')
+        OR encode(device.dev_eui, 'hex') = ANY($2::text[])
+    )
+"""
+
+# listed route skfs and their diff with helium_devices, both rewritten by every reconciliation.
+skf_tables = """
+    CREATE UNLOGGED TABLE IF NOT EXISTS helium_skfs_listed (
+        devaddr bigint,
+        session_key bytea,
+        max_copies int
+    );
+    CREATE UNLOGGED TABLE IF NOT EXISTS helium_skfs_diff (
+        devaddr bigint,
+        session_key bytea,
+        local_copies int,
+        primary key (devaddr, session_key)
+    );
+"""
+
+# enabled helium_devices sessions full joined with the listed route skfs.
+# local_copies is null for a skf to remove, otherwise the session is missing or its max_copies differ.
+route_skfs_diff = """
+    INSERT INTO helium_skfs_diff
+    WITH local AS (
+        SELECT DISTINCT ON (devaddr, session_key) *
+        FROM (
+            SELECT ('x' || lpad(dev_addr, 16, '0'))::bit(64)::bigint AS devaddr,
+                decode(nws_key, 'hex') AS session_key,
+                max_copies
+            FROM helium_devices
+            WHERE is_disabled=false
+            AND dev_addr != ''
+        ) AS sessions
+    )
+    SELECT coalesce(local.devaddr, listed.devaddr) AS devaddr,
+        coalesce(local.session_key, listed.session_key) AS session_key,
+        local.max_copies AS local_copies
+    FROM local
+    FULL JOIN {listed} AS listed
+        ON listed.devaddr = local.devaddr AND listed.session_key = local.session_key
+    WHERE local.devaddr IS NULL
+    OR listed.devaddr IS NULL
+    OR local.max_copies IS DISTINCT FROM listed.max_copies;
+"""
+
+# the diff rows of the next $2 devaddrs after $1, a devaddr is never split over two pages.
+skf_diff_page = """
+    SELECT devaddr, session_key, local_copies
+    FROM helium_skfs_diff
+    WHERE devaddr IN (
+        SELECT DISTINCT devaddr FROM helium_skfs_diff
+        WHERE devaddr > $1
+        ORDER BY devaddr
+        LIMIT $2
+    )
+    ORDER BY devaddr, session_key;
+"""
+
+
+def skf_report(latencies: list, failed: int, elapsed: float) -> str:
+    if not latencies:
+        return f'{failed} chunks failed' if failed else 'no changes'
+    latencies.sort()
+    return (
+        f'{len(latencies)} chunks in {elapsed:.1f}s, {failed} failed, '
+        f'latency p50 {latencies[len(latencies) // 2]:.2f}s '
+        f'p95 {latencies[int(len(latencies) * 0.95)]:.2f}s max {latencies[-1]:.2f}s'
+    )
 
 
 class ChirpDeviceKeys:
@@ -12,31 +115,32 @@ class ChirpDeviceKeys:
         self,
         route_id: str,
         pool,
-        chirpstack_host: str,
-        chirpstack_token: str,
+        chirpstack: ChirpstackClient,
+        mirror=None,
     ):
         self.route_id = route_id
         self.pool = pool
-        self.cs_gprc = chirpstack_host
-        self.auth_token = [("authorization", f"Bearer {chirpstack_token}")]
+        self.chirpstack = chirpstack
+        self.mirror = mirror        # RouteMirror, diffed against instead of list_skfs once synced
+        self.writer = DeviceWriter(pool)
+        self.synced_at = None       # chirpstack db time the last sync pass started
+        self.full_synced_at = 0.0   # monotonic time of the last full sync
+        self.retry = []             # dev_euis that failed the last pass
+        self.listed = {}            # dev_eui -> updated_at seen by the last 'list' pass
 
-    async def db_fetch(self, query: str):
+    async def db_fetch(self, query: str, *params):
         async with self.pool.acquire() as conn:
             async with conn.transaction():
-                return await conn.fetch(query)
+                return await conn.fetch(query, *params)
 
     async def db_transaction(self, query: str, *params):
         async with self.pool.acquire() as conn:
             async with conn.transaction():
                 await conn.execute(query, *params)
 
-    async def fetch_all_devices(self) -> list[str]:
-        query = """
-            SELECT encode(dev_eui, 'hex') AS dev_eui
-            FROM device
-            WHERE is_disabled=false;
-        """
-        return [dev['dev_eui'] for dev in await self.db_fetch(query)]
+    async def fetch_all_devices(self, since=None) -> list[str]:
+        query = f"SELECT encode(device.dev_eui, 'hex') AS dev_eui {changed_devices};"
+        return [dev['dev_eui'] for dev in await self.db_fetch(query, since, self.retry)]
 
     def chunker(self, seq, size):
         return (seq[pos:pos + size] for pos in range(0, len(seq), size))
@@ -44,147 +148,276 @@ class ChirpDeviceKeys:
     ###########################################################################
     # Chirpstack gRPC API calls
     ###########################################################################
+    # the sync passes exist to catch what stream invalidation missed, they bypass the device cache.
     async def get_device(self, dev_eui: str) -> dict[str]:
-        async with grpc.aio.insecure_channel(self.cs_gprc) as channel:
-            client = api.DeviceServiceStub(channel)
-            req = api.GetDeviceRequest()
-            req.dev_eui = dev_eui
-            resp = await client.Get(req, metadata=self.auth_token)
-            data = MessageToDict(resp)["device"]
-        return data
+        resp = await self.chirpstack.fetch_device(dev_eui)
+        return MessageToDict(resp)["device"]
 
     async def get_device_activation(self, dev_eui: str) -> dict[str]:
-        async with grpc.aio.insecure_channel(self.cs_gprc) as channel:
-            client = api.DeviceServiceStub(channel)
-            req = api.GetDeviceActivationRequest()
-            req.dev_eui = dev_eui
-            resp = await client.GetActivation(req, metadata=self.auth_token)
-            data = MessageToDict(resp)
-            if bool(data):
-                return data["deviceActivation"]
+        resp = await self.chirpstack.fetch_device_activation(dev_eui)
+        data = MessageToDict(resp)
+        if bool(data):
+            return data["deviceActivation"]
         return data
 
     async def get_merged_keys(self, dev_eui: str) -> str:
-        devices = {
-            "devAddr": "",
-            "appSKey": "",
-            "nwkSEncKey": "",
-            "name": "",
+        device = await self.get_device(dev_eui)
+        if device.get("isDisabled"):
+            # listed devices include disabled ones, their euis are handled by the request stream.
+            return f"Skipped disabled: {dev_eui}"
+        activation = await self.get_device_activation(dev_eui)
+        # batched with the other devices synced concurrently.
+        await self.writer.write(merged_record(device, activation))
+        return f"Updated: {dev_eui}"
+
+    async def update_device_status(self, concurrency: int = device_sync_concurrency):
+        """Sync the devices changed since the last pass, or all of them every `device_full_sync_interval`.
+
+        Changes are found from chirpstack's `device.updated_at` (api
+        updates) and a dev_addr that differs from helium_devices (joins),
+        the high-water mark is chirpstack's db clock when the pass started.
+        """
+        full_due = time.monotonic() - self.full_synced_at >= device_full_sync_interval
+        full = self.synced_at is None or full_due
+        since = None if full else self.synced_at
+        synced_at = (await self.db_fetch('SELECT now() AS now;'))[0]['now']
+        print(f'update_device_status: {"full" if full else f"incremental since {since}"} sync')
+        if device_sync_mode == 'sql':
+            self.retry = await self.sync_devices_sql(since)
+        elif device_sync_mode == 'list':
+            self.retry = await self.sync_devices_list(concurrency, full)
+        else:
+            self.retry = await self.sync_devices_grpc(concurrency, since)
+        self.synced_at = synced_at
+        if full:
+            self.full_synced_at = time.monotonic()
+
+    async def sync_devices_grpc(self, concurrency: int = device_sync_concurrency, since=None) -> list[str]:
+        """Sync enabled devices selected from chirpstack's device table over grpc, returns those that failed."""
+        return await self.sync_devices(await self.fetch_all_devices(since), concurrency)
+
+    async def sync_devices_list(self, concurrency: int = device_sync_concurrency, full: bool = True) -> list[str]:
+        """Sync devices found through the chirpstack List apis, returns those that failed.
+
+        The listing has no keys, join eui or variables, so only devices
+        whose `updated_at` moved since the last listing, that are missing
+        from helium_devices or failed last time are looked up with `Get`,
+        all of them on a full sync. Joins are picked up by the join stream.
+        """
+        start = time.monotonic()
+        listed = {
+            device.dev_eui: device.updated_at.ToMicroseconds()
+            for device in await self.chirpstack.list_devices(chirpstack_tenant_id)
         }
+        known = {row['dev_eui'] for row in await self.db_fetch("SELECT dev_eui FROM helium_devices;")}
+        retry = set(self.retry)
+        devices = [
+            dev_eui for dev_eui, updated_at in listed.items()
+            if full or dev_eui not in known or dev_eui in retry or self.listed.get(dev_eui) != updated_at
+        ]
+        print(f'update_device_status: listed {len(listed)} devices in {time.monotonic() - start:.1f}s')
+        self.listed = listed
+        return await self.sync_devices(devices, concurrency)
 
-        devices.update(await self.get_device(dev_eui))
-        devices.update(await self.get_device_activation(dev_eui))
-
-        max_copies = 0
-        if devices.get("variables") and "max_copies" in devices.get("variables"):
-            max_copies = int(devices["variables"]["max_copies"])
-        if "fCntUp" not in devices.keys():
-            devices["fCntUp"] = 0
-        if "nFCntDown" not in devices.keys():
-            devices["nFCntDown"] = 0
-
-        query = """
-            INSERT INTO helium_devices
-            (dev_eui, join_eui, dev_addr, max_copies, aps_key, nws_key, dev_name, fcnt_up, fcnt_down)
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-            ON CONFLICT (dev_eui) DO UPDATE
-            SET join_eui = EXCLUDED.join_eui,
-                dev_addr = EXCLUDED.dev_addr,
-                max_copies = EXCLUDED.max_copies,
-                aps_key = EXCLUDED.aps_key,
-                nws_key = EXCLUDED.nws_key,
-                dev_name = EXCLUDED.dev_name,
-                fcnt_up = EXCLUDED.fcnt_up,
-                fcnt_down = EXCLUDED.fcnt_down;
+    async def sync_devices(self, devices: list[str], concurrency: int = device_sync_concurrency) -> list[str]:
+        """Sync `devices` into helium_devices, `concurrency` at a time, returns those that failed.
+
+        A device that fails is logged and skipped, the rest of the pass
+        carries on. Progress is logged every 10%, and the totals and
+        duration once the pass is done.
         """
-        await self.db_transaction(
-            query,
-            devices["devEui"],
-            devices["joinEui"],
-            devices["devAddr"],
-            max_copies,
-            devices["appSKey"],
-            devices["nwkSEncKey"],
-            devices["name"],
-            devices["fCntUp"],
-            devices["nFCntDown"],
+        start = time.monotonic()
+        total = len(devices)
+        step = max(1, total // 10)
+        done = 0
+        failed = []
+        pending = iter(devices)
+
+        async def sync():
+            nonlocal done
+            # workers share one iterator, so no more than `concurrency` devices are in flight.
+            for dev_eui in pending:
+                try:
+                    await self.get_merged_keys(dev_eui)
+                except Exception as err:
+                    failed.append(dev_eui)
+                    logging.info(f'update_device_status {dev_eui}: {err!r}')
+                done += 1
+                if done % step == 0:
+                    print(f'update_device_status: {done}/{total} devices, {time.monotonic() - start:.1f}s')
+
+        await asyncio.gather(*[sync() for _ in range(max(1, min(concurrency, total)))])
+        incr('device_sync:updated', done - len(failed))
+        incr('device_sync:failed', len(failed))
+        print(
+            f'update_device_status: {done - len(failed)} updated, {len(failed)} failed '
+            f'of {total} devices in {time.monotonic() - start:.1f}s'
         )
-        return f"Updated: {dev_eui}"
+        return failed
 
-    async def helium_skfs_update(self):
+    async def fetch_device_rows(self, since=None) -> list:
+        """Enabled devices, see `fetch_all_devices`, with the fields `get_merged_keys` reads over grpc."""
+        query = f"""
+            SELECT
+                encode(device.dev_eui, 'hex') AS dev_eui,
+                encode(device.join_eui, 'hex') AS join_eui,
+                device.name,
+                coalesce((device.variables->>'max_copies')::int, 0) AS max_copies,
+                device.device_session
+            {changed_devices};
         """
-        TODO:
-            run function on a device join success, or on a device update.
+        return await self.db_fetch(query, since, self.retry)
+
+    def device_record(self, row) -> DeviceRecord:
+        """helium_devices row of a `fetch_device_rows` row."""
+        dev_addr = nws_key = aps_key = ''
+        fcnt_up = fcnt_down = 0
+        if row['device_session']:
+            dev_addr, nws_key, aps_key, fcnt_up, fcnt_down = decode_device_session(row['device_session'])
+        return DeviceRecord(
+            dev_eui=row['dev_eui'],
+            join_eui=row['join_eui'],
+            dev_addr=dev_addr,
+            max_copies=row['max_copies'],
+            aps_key=aps_key,
+            nws_key=nws_key,
+            dev_name=row['name'],
+            fcnt_up=fcnt_up,
+            fcnt_down=fcnt_down,
+        )
+
+    async def sync_devices_sql(self, since=None) -> list[str]:
+        """Sync enabled devices from chirpstack's own tables, no grpc calls, returns those that failed.
+
+        One query reads the devices with their variables and device
+        session, the session is decoded here and everything is written
+        with one upsert.
         """
-        helium_devices = """
-            SELECT dev_addr, nws_key, max_copies
-            FROM helium_devices
-            WHERE is_disabled=false
-            AND dev_addr != '';
+        start = time.monotonic()
+        records = []
+        failed = []
+        for row in await self.fetch_device_rows(since):
+            try:
+                records.append(self.device_record(row))
+            except Exception as err:
+                failed.append(row['dev_eui'])
+                logging.info(f'sync_devices_sql {row["dev_eui"]}: {err!r}')
+        if records:
+            await upsert_devices(self.pool, records)
+        incr('device_sync:updated', len(records))
+        incr('device_sync:failed', len(failed))
+        print(
+            f'update_device_status: {len(records)} updated, {len(failed)} failed '
+            f'from the device table in {time.monotonic() - start:.1f}s'
+        )
+        return failed
+
+    async def helium_skfs_update(self):
+        """Reconcile the route's skfs with helium_devices.
+
+        The route side is the mirror table while the mirror is synced,
+        otherwise `list_skfs` is streamed into `helium_skfs_listed`. The
+        diff of both sides is written to `helium_skfs_diff` by postgres and
+        read back in devaddr order, `skf_diff_window` devaddrs at a time,
+        so memory stays bounded by the window whatever the size of the
+        route. No connection is held while updates are sent.
         """
-        all_helium_devices = await self.db_fetch(helium_devices)
+        await self.db_transaction(skf_tables)
+        if self.mirror is not None and self.mirror.synced.is_set():
+            await self.mirror.flush()
+            listed = 'helium_route_skfs'
+        else:
+            listed = await self.stage_route_skfs()
 
-        skfs_list = await get_route_skfs()
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                await con.execute('TRUNCATE helium_skfs_diff;')
+                await con.execute(route_skfs_diff.format(listed=listed))
 
-        # Convert the lists to sets for efficient set operations
-        # compare dev_addr & session_key for match else remove
-        all_helium_sessions_set = {
-            (d["dev_addr"], d["nws_key"]) for d in all_helium_devices
-        }
+        start = time.monotonic()
+        latencies, failed = [], 0
+        adds = removes = 0
+        after = -1
+        while True:
+            window = await self.db_fetch(skf_diff_page, after, skf_diff_window)
+            if not window:
+                break
+            after = window[-1]['devaddr']
+            adds += sum(row['local_copies'] is not None for row in window)
+            removes += sum(row['local_copies'] is None for row in window)
+            sent, lost = await self.submit_skfs(self.skf_phases(window))
+            latencies += sent
+            failed += lost
 
-        all_skfs_sessions_set = {
-            (d["devaddr"], d["sessionKey"]) for d in skfs_list
-        }
+        report = f'{adds} adds, {removes} removes, {skf_report(latencies, failed, time.monotonic() - start)}'
+        logging.info(f'skfs_update: {report}')
 
-        devices_to_remove = all_helium_sessions_set ^ all_skfs_sessions_set
-        logging.info(f"Devices_to_remove: {devices_to_remove}")
+        return f"Updated SKFS: {report}"
 
-        # only update max_copies if changed, do not remove and re add if only max copies changes
-        # as it seems to make the session key hang and not pass data.
-        all_helium_devices_set = {
-            (d["dev_addr"], d["nws_key"], d["max_copies"])
-            for d in all_helium_devices
-        }
+    async def stage_route_skfs(self) -> str:
+        """Stream the route's skfs into `helium_skfs_listed`, returns its name."""
+        await copy_listing(self.pool, 'helium_skfs_listed', skf_listing(self.route_id), skf_diff_window)
+        await self.db_transaction('ANALYZE helium_skfs_listed;')
+        return 'helium_skfs_listed'
 
-        skfs_list_set = {
-            (d["devaddr"], d["sessionKey"], d["maxCopies"])
-            for d in skfs_list
-        }
+    def skf_phases(self, rows: list) -> list[list]:
+        """Updates for diff rows, removes for a devaddr go out before the adds for it."""
+        removes, adds = [], []
+        for row in rows:
+            skf = Skf(row['devaddr'], row['session_key'], row['local_copies'] or 0)
+            if row['local_copies'] is None:
+                removes.append(skf.update(iot_config.ActionV1.remove))
+            else:
+                # only max_copies changed is a plain add, do not remove and re add as it
+                # seems to make the session key hang and not pass data.
+                adds.append(skf.update(iot_config.ActionV1.add))
+        removed = {skf.devaddr for skf in removes}
+        return [
+            removes + [skf for skf in adds if skf.devaddr not in removed],
+            [skf for skf in adds if skf.devaddr in removed],
+        ]
+
+    async def submit_skfs(self, phases: list[list], concurrency: int = skf_concurrency) -> tuple[list, int]:
+        """Send skf updates in chunks of 100, `concurrency` chunks at a time.
+
+        Each phase is sent completely before the next starts. A chunk that
+        fails is retried up to `skf_attempts` times. Updates in later phases
+        for a devaddr whose remove was given up on are left for the next
+        pass, so an add never lands ahead of its remove. Returns the latency
+        of every chunk sent and the number of chunks given up on.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+        failed = 0
+        blocked = set()     # devaddrs of removes given up on
+
+        async def submit(group: list):
+            nonlocal failed
+            async with semaphore:
+                for attempt in range(1, skf_attempts + 1):
+                    sent = time.monotonic()
+                    try:
+                        resp = await update_device_skfs(self.route_id, group)
+                        latencies.append(time.monotonic() - sent)
+                        logging.info(f'skfs_to_update: {resp}')
+                        return
+                    except Exception as err:
+                        logging.info(f'skfs chunk of {len(group)}, attempt {attempt}: {err!r}')
+                        if attempt < skf_attempts:
+                            await asyncio.sleep(2 ** attempt)
+                failed += 1
+                blocked.update(skf.devaddr for skf in group if skf.action == iot_config.ActionV1.remove)
+
+        for phase in phases:
+            if blocked:
+                held = [skf for skf in phase if skf.devaddr in blocked]
+                if held:
+                    logging.info(f'skfs: {len(held)} updates held back behind failed removes, left for the next pass')
+                    incr('skfs:deferred', len(held))
+                    phase = [skf for skf in phase if skf.devaddr not in blocked]
+            # with rpc we can make update to a max of 100 skfs in one request
+            await asyncio.gather(*[submit(group) for group in self.chunker(phase, 100)])
 
-        # Devices to add to skfs_list
-        devices_to_add = all_helium_devices_set - skfs_list_set
-        logging.info(f"Devices_to_add: {devices_to_add}")
-
-        # with rpc we can make update to a max of 100 skfs in one request
-        rm_skfs = []
-        add_skfs = []
-
-        if devices_to_remove:
-            rm_skfs = [
-                iot_config.RouteSkfUpdateReqV1RouteSkfUpdateV1(
-                    devaddr=int(dev_addr, 16),
-                    session_key=nws_key,
-                    action=iot_config.ActionV1(1)
-                ) for dev_addr, nws_key in devices_to_remove
-            ]
-
-        if devices_to_add:
-            add_skfs = [
-                iot_config.RouteSkfUpdateReqV1RouteSkfUpdateV1(
-                    devaddr=int(dev_addr, 16),
-                    session_key=nws_key,
-                    action=iot_config.ActionV1(0),
-                    max_copies=max_copies
-                ) for dev_addr, nws_key, max_copies in devices_to_add
-            ]
-
-        skfs_action = rm_skfs + add_skfs
-
-        if skfs_action:
-            """Chunk updates max of 100 requests at a time, helium rpc restriction"""
-            for group in self.chunker(skfs_action, 100):
-                logging.info(f'Chunked_Update: {group}')
-                skfs_update_chunk = await update_device_skfs(self.route_id, group)
-                logging.info(f'skfs_to_update: {skfs_update_chunk}')
-
-        return "Updated SKFS"
+        incr('skfs:chunks', len(latencies))
+        incr('skfs:chunks_failed', failed)
+        return latencies, failed
@@ -1,12 +1,18 @@
 import os
+import asyncio
 from functools import wraps
-import redis.asyncio as redis
-import grpc
 from google.protobuf.json_format import MessageToJson, MessageToDict
-from chirpstack_api import api, stream
+from chirpstack_api import stream
 import logging
 
-from ChirpHeliumCrypto import sync_device_euis
+from ChirpHeliumCrypto import sync_device_euis, update_device_skfs
+from StreamDecoder import decode_api_request, api_request_dev_eui, is_device_change
+from ChirpstackClient import ChirpstackClient
+from RouteSkf import Skf, session_updates
+
+
+# devices whose backlog state is applied at once, their eui updates share a stream.
+catchup_concurrency = int(os.getenv('REQUEST_CATCHUP_CONCURRENCY', 100))
 
 
 def my_logger(orig_func):
@@ -27,39 +33,29 @@ def my_logger(orig_func):
     return wrapper
 
 
-# -----------------------------------------------------------------------------
-# CHIRPSTACK REDIS CONNECTION
-# -----------------------------------------------------------------------------
-redis_server = os.getenv('REDIS_HOST')
-rpool = redis.ConnectionPool(host=redis_server, port=6379, db=0)
-rdb = redis.Redis(connection_pool=rpool, decode_responses=True)
-
-
 class ChirpstackStreams:
     def __init__(
         self,
         route_id: str,
         pool,
-        chirpstack_host: str,
-        chirpstack_token: str,
+        chirpstack: ChirpstackClient,
     ):
         self.route_id = route_id
         self.pool = pool
-        self.cs_gprc = chirpstack_host
-        self.auth_token = [('authorization', f'Bearer {chirpstack_token}')]
+        self.chirpstack = chirpstack
 
     ###########################################################################
     # functions to handle helium device db transactions
     ###########################################################################
-    async def db_transaction(self, query):
+    async def db_transaction(self, query, *params):
         async with self.pool.acquire() as con:
             async with con.transaction():
-                await con.execute(query)
+                await con.execute(query, *params)
 
-    async def db_fetch(self, query):
+    async def db_fetch(self, query, *params):
         async with self.pool.acquire() as con:
             async with con.transaction():
-                return await con.fetch(query)
+                return await con.fetch(query, *params)
 
     async def fetch_active_devices(self) -> list[str]:
         query = "SELECT dev_eui FROM device WHERE is_disabled=false;"
@@ -89,73 +85,150 @@ class ChirpstackStreams:
     # Chirpstack gRPC API calls
     ###########################################################################
     async def get_device_request(self, dev_eui: str):
-        async with grpc.aio.insecure_channel(self.cs_gprc) as channel:
-            client = api.DeviceServiceStub(channel)
-            req = api.GetDeviceRequest()
-            req.dev_eui = dev_eui
-            resp = await client.Get(req, metadata=self.auth_token)
-            data = MessageToDict(resp)['device']
+        data = await self.get_device_request_data(dev_eui)
         return data['devEui'], data['joinEui']
 
     async def get_device_request_data(self, dev_eui: str):
-        async with grpc.aio.insecure_channel(self.cs_gprc) as channel:
-            client = api.DeviceServiceStub(channel)
-            req = api.GetDeviceRequest()
-            req.dev_eui = dev_eui
-            resp = await client.Get(req, metadata=self.auth_token)
-            data = MessageToDict(resp)['device']
-        return data
+        resp = await self.chirpstack.get_device(dev_eui)
+        return MessageToDict(resp)['device']
 
     async def get_device_activation(self, dev_eui: str):
-        async with grpc.aio.insecure_channel(self.cs_gprc) as channel:
-            client = api.DeviceServiceStub(channel)
-            req = api.GetDeviceActivationRequest()
-            req.dev_eui = dev_eui
-            resp = await client.GetActivation(req, metadata=self.auth_token)
-            data = MessageToDict(resp)['deviceActivation']
-        return data
+        resp = await self.chirpstack.get_device_activation(dev_eui)
+        return MessageToDict(resp)['deviceActivation']
 
     ###########################################################################
     # follow internal redis stream gRPC for actionable changes
     ###########################################################################
-    async def api_stream_requests(self):
-        stream_key = "api:stream:request"
-        last_id = '0'
-        while True:
+    def api_stream_requests(self, dispatcher):
+        dispatcher.register(
+            'api:stream:request',
+            b'request',
+            self.handle_request,
+            partition=api_request_dev_eui,
+            accept=is_device_change,
+            catch_up=self.catch_up_requests,
+        )
+
+    async def handle_request(self, messages: list, consumer: str) -> dict:
+        # each device's requests in order, devices concurrently so their eui updates share a stream.
+        devices = {}
+        for message_id, request in messages:
             try:
-                resp = await rdb.xread({stream_key: last_id}, count=1, block=0)
-
-                for message in resp[0][1]:
-                    last_id = message[0]
-
-                    if b'request' in message[1]:
-                        msg = message[1][b'request']
-                        pl = stream.api_request_pb2.ApiRequestLog()
-                        pl.ParseFromString(msg)
-                        req = MessageToDict(pl)
-                        if 'method' not in req.keys():
-                            continue
-
-                        match req['service']:
-                            case 'api.DeviceService':
-                                if req['method'] == 'Create':
-                                    print('========== API Create Euis ==========')
-                                    print(MessageToJson(pl))
-                                    await self.add_device_euis(req['metadata'])
-
-                                if req['method'] == 'Delete':
-                                    print('========== API Delete Euis ==========')
-                                    print(MessageToJson(pl))
-                                    await self.remove_device_euis(req['metadata'])
-
-                                if req['method'] == 'Update':
-                                    print('========== API Update Euis ==========')
-                                    print(MessageToJson(pl))
-                                    await self.update_device_euis(req['metadata'])
+                dev_eui = api_request_dev_eui(request)
+            except Exception:
+                dev_eui = ''
+            devices.setdefault(dev_eui, []).append((message_id, request))
+
+        failed = {}
+
+        async def handle_device(entries: list):
+            for message_id, request in entries:
+                try:
+                    await self.api_request(request)
+                except Exception as err:
+                    failed[message_id] = err
+
+        await asyncio.gather(*[handle_device(entries) for entries in devices.values()])
+        return failed
+
+    async def api_request(self, request: bytes):
+        pl = decode_api_request(request)
+        if not pl.method:
+            return
+
+        match pl.service:
+            case 'api.DeviceService':
+                if pl.method in ('Update', 'Delete') and 'dev_eui' in pl.metadata:
+                    self.chirpstack.invalidate(pl.metadata['dev_eui'])
+
+                if pl.method == 'Create':
+                    print('========== API Create Euis ==========')
+                    print(MessageToJson(pl))
+                    await self.add_device_euis(dict(pl.metadata))
+
+                if pl.method == 'Delete':
+                    print('========== API Delete Euis ==========')
+                    print(MessageToJson(pl))
+                    await self.remove_device_euis(dict(pl.metadata))
+
+                if pl.method == 'Update':
+                    print('========== API Update Euis ==========')
+                    print(MessageToJson(pl))
+                    await self.update_device_euis(dict(pl.metadata))
+
+    async def catch_up_requests(self, pages) -> dict:
+        """Backlog replay, fold each device's Create/Update/Delete into its final state.
 
+        Returns the last request of each device that could not be applied, by message id.
+        """
+        devices = {}
+        last_ids = {}   # dev_eui -> id of its last request in the backlog
+        async for page in pages:
+            for message_id, request in page:
+                pl = decode_api_request(request)
+                dev_eui = pl.metadata.get('dev_eui')
+                if not dev_eui:
+                    continue
+                last_ids[dev_eui] = message_id
+                state = devices.setdefault(dev_eui, {'exists': None, 'deleted': False, 'is_disabled': None})
+                match pl.method:
+                    case 'Create':
+                        state['exists'] = True
+                    case 'Delete':
+                        state['exists'] = False
+                        state['deleted'] = True
+                        state['is_disabled'] = None
+                    case 'Update':
+                        state['exists'] = True
+                        state['is_disabled'] = pl.metadata.get('is_disabled', state['is_disabled'])
+
+        print(f'Catch-up requests: {len(devices)} devices')
+
+        failed = {}
+
+        async def apply(dev_eui: str, state: dict):
+            try:
+                await self.apply_device_state(dev_eui, state)
             except Exception as err:
-                logging.info(f'api_stream_requests: {err}')
-                pass
+                # the periodic device sync never sends eui actions, the device's last request is dead-lettered.
+                logging.info(f'catch_up_requests {dev_eui}: {err!r}')
+                failed[last_ids[dev_eui]] = err
+
+        states = list(devices.items())
+        for pos in range(0, len(states), catchup_concurrency):
+            await asyncio.gather(*[
+                apply(dev_eui, state) for dev_eui, state in states[pos:pos + catchup_concurrency]
+            ])
+        return failed
+
+    async def apply_device_state(self, dev_eui: str, state: dict):
+        """One eui action per device for its final state after a backlog."""
+        self.chirpstack.invalidate(dev_eui)
+        known = bool(await self.db_fetch("SELECT 1 FROM helium_devices WHERE dev_eui=$1;", dev_eui))
+        if known and state['deleted']:
+            # deleted, and possibly re-created with other euis, drop what we had.
+            await self.remove_device_euis({'dev_eui': dev_eui})
+            known = False
+        if not state['exists']:
+            return
+
+        if known:
+            if state['is_disabled'] is not None:
+                await self.update_device_euis({'dev_eui': dev_eui, 'is_disabled': state['is_disabled']})
+            return
+        # the device's current disabled flag, the backlog may not hold its last change.
+        device = await self.get_device_request_data(dev_eui)
+        if device.get('isDisabled'):
+            # created disabled, record it without adding euis.
+            dev_eui, join_eui = device['devEui'], device['joinEui']
+            query = """
+                INSERT INTO helium_devices (dev_eui, join_eui, is_disabled)
+                VALUES ($1, $2, true)
+                ON CONFLICT (dev_eui) DO UPDATE SET join_eui = EXCLUDED.join_eui, is_disabled = true;
+            """
+            await self.db_transaction(query, dev_eui, join_eui)
+        else:
+            await self.add_device_euis({'dev_eui': dev_eui})
 
     # @my_logger
     async def add_device_euis(self, data: dict):
@@ -185,7 +258,7 @@ class ChirpstackStreams:
     async def remove_device_euis(self, data: dict):
         """
         On device being removed using chirpstack webui or api.
-            - call dev_addr and nws_keys to be removed from hpr skfs if activated.
+            - remove the device session from hpr skfs if activated.
             - call device from helium_devices db on delete and remove from hpr device euis
             - remove device from helium_devices db
         """
@@ -196,7 +269,12 @@ class ChirpstackStreams:
         print(f'Remove Device: {device}')
 
         query = "SELECT * FROM helium_devices WHERE dev_eui='{}';".format(device)
-        data = (await self.db_fetch(query))[0]
+        rows = await self.db_fetch(query)
+        if not rows:
+            # never synced to helium, nothing to remove from the route.
+            print(f'Remove Device: {device} not in helium_devices')
+            return
+        data = rows[0]
 
         dev_eui = data['dev_eui']    # this should be a string
         join_eui = data['join_eui']  # this should be a string
@@ -205,7 +283,10 @@ class ChirpstackStreams:
         print('remove-device:', action, join_eui, dev_eui, self.route_id)
         await sync_device_euis(action, join_eui, dev_eui, self.route_id)
 
-        # add in remove device skfs here in lookup?
+        skfs = session_updates(Skf.of_session(data['dev_addr'], data['nws_key']), None)
+        if skfs:
+            print('remove-device skfs:', skfs)
+            await update_device_skfs(self.route_id, skfs)
 
         # delete or disable device in helium_device table.
         delete_device = """
@@ -218,8 +299,8 @@ class ChirpstackStreams:
     async def update_device_euis(self, data: dict):
         """
         On device being disabled in chirpstack webui or api
-            - remove device euis on disable toggle from hpr
-            - add device euis to hpr on enable toggle
+            - remove device euis and session on disable toggle from hpr
+            - add device euis and session to hpr on enable toggle
             - update device device status to is_disabled in helium_devices
             - update max_copies
         """
@@ -227,9 +308,15 @@ class ChirpstackStreams:
             return
 
         device = data['dev_eui']
-        is_disabled = data['is_disabled']
+        if 'is_disabled' not in data.keys():
+            return
 
-        dev_eui, join_eui = await self.get_device_request(device)
+        # the device's current state rather than the request's, a retried request
+        # may be older than ones already applied for the same device. the caller
+        # dropped its cached device.
+        current = await self.get_device_request_data(device)
+        dev_eui, join_eui = current['devEui'], current['joinEui']
+        is_disabled = 'true' if current.get('isDisabled') else 'false'
         if is_disabled == 'true':
             action = 1
             query = """
@@ -245,4 +332,12 @@ class ChirpstackStreams:
             await self.db_transaction(query)
         print('action', action, 'join', join_eui, 'dev', dev_eui)
         await sync_device_euis(action, join_eui, dev_eui, self.route_id)
+
+        rows = await self.db_fetch(
+            "SELECT dev_addr, nws_key, max_copies FROM helium_devices WHERE dev_eui=$1;", dev_eui)
+        session = Skf.of_session(rows[0]['dev_addr'], rows[0]['nws_key'], rows[0]['max_copies']) if rows else None
+        skfs = session_updates(session, None) if action else session_updates(None, session)
+        if skfs:
+            print('update-device skfs:', skfs)
+            await update_device_skfs(self.route_id, skfs)
         return
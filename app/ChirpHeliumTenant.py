@@ -1,18 +1,10 @@
 import os
 import asyncio
-import redis.asyncio as redis
-from math import ceil
-from google.protobuf.json_format import MessageToDict
-from chirpstack_api import stream
 import logging
 from UsagePublisher import publish_usage_event
-
-# -----------------------------------------------------------------------------
-# CHIRPSTACK REDIS CONNECTION
-# -----------------------------------------------------------------------------
-redis_server = os.getenv('REDIS_HOST')
-rpool = redis.ConnectionPool(host=redis_server, port=6379, db=0)
-rdb = redis.Redis(connection_pool=rpool, decode_responses=True)
+from DcAccumulator import DcAccumulator
+from StreamDecoder import decode_uplink_meta
+from ChirpstackClient import ChirpstackClient
 
 
 class ChirpstackTenant:
@@ -20,81 +12,59 @@ class ChirpstackTenant:
         self,
         route_id: str,
         pool,
-        chirpstack_host: str,
-        chirpstack_token: str,
+        chirpstack: ChirpstackClient,
     ):
         self.route_id = route_id
         self.pool = pool
-        self.cs_gprc = chirpstack_host
-        self.auth_token = [('authorization', f'Bearer {chirpstack_token}')]
+        self.chirpstack = chirpstack
 
-    async def db_transaction(self, query):
+    async def db_transaction(self, query, *params):
         async with self.pool.acquire() as con:
             async with con.transaction():
-                await con.execute(query)
+                await con.execute(query, *params)
 
-    async def db_fetch(self, query):
+    async def db_fetch(self, query, *params):
         async with self.pool.acquire() as con:
             async with con.transaction():
-                return await con.fetch(query)
-
-    async def stream_meta(self):
-        stream_key = 'stream:meta'
-        last_id = '0'
-        while True:
-            try:
-                resp = await rdb.xread({stream_key: last_id}, count=1, block=0)
-
-                for message in resp[0][1]:
-                    last_id = message[0]
+                return await con.fetch(query, *params)
 
-                    if b"up" in message[1]:
-                        b = message[1][b"up"]
-                        pl = stream.meta_pb2.UplinkMeta()
-                        pl.ParseFromString(b)
-                        data = MessageToDict(pl)
-                        await self.meta_up(data)
+    def stream_meta(self, dispatcher):
+        # acknowledged by the accumulator once the dc used is committed.
+        dispatcher.register('stream:meta', b'up', self.handle_meta, auto_ack=False)
+        on_flush = self.publish_usage if os.getenv('PUBLISH_USAGE_EVENTS') == 'True' else None
+        self.accumulator = DcAccumulator(self.pool, dispatcher, 'stream:meta', on_flush)
 
-            except Exception as exc:
-                logging.info(f'stream_meta: {exc}')
-
-    async def meta_up(self, data: dict):
-        dev_eui = data['devEui']
-        dupes = len(data['rxInfo'])
-        # dc = ceil(data['phyPayloadByteCount'] / 24)
-        if 'applicationPayloadByteCount' not in data.keys():
-            # if an empty msg is sent by a device it doesnt pass this key.
-            print('********** applicationPayloadByteCount **********')
-            print(data)
-            dc = ceil(data['phyPayloadByteCount'] / 24)
-            print('**********    **********  *********    **********')
-        else:
-            dc = ceil(data['applicationPayloadByteCount'] / 24)
+    async def handle_meta(self, messages: list, consumer: str):
+        usage = [
+            (message_id, *self.meta_up(*decode_uplink_meta(up)))
+            for message_id, up in messages
+        ]
+        await self.accumulator.add(consumer, usage)
 
+    def meta_up(self, dev_eui: str, dupes: int, dc: int) -> tuple[str, int]:
         total_dc = dupes * dc
         logging.info(f"dev_eui: {dev_eui} | MSG DC {dc} | Dupes: {dupes} | Total DC: {total_dc}")
-        query = """
-            UPDATE helium_devices SET dc_used = (dc_used + {}) WHERE dev_eui='{}';
-        """.format(total_dc, dev_eui)
-        await self.db_transaction(query)
+        return dev_eui, total_dc
 
-        if os.getenv('PUBLISH_USAGE_EVENTS') == 'True':
-            # First we get the tenant id for the device...
-            query = """
-                SELECT application.tenant_id, application.id FROM application
-                JOIN device ON application.id = device.application_id
-                WHERE device.dev_eui = decode('%s', 'hex');
-            """ % dev_eui
-            result = await self.db_fetch(query)
-            tenant_id = None
-            application_id = None
-            for row in result:
-                tenant_id = row['tenant_id']
-                application_id = row['id']
-            loop = asyncio.get_running_loop()
-            await loop.run_in_executor(
+    async def publish_usage(self, usage: list[tuple[str, int]]):
+        # First we get the tenant id for each device in the batch...
+        query = """
+            SELECT encode(device.dev_eui, 'hex') AS dev_eui, application.tenant_id, application.id
+            FROM application
+            JOIN device ON application.id = device.application_id
+            WHERE device.dev_eui = ANY($1::bytea[]);
+        """
+        dev_euis = {bytes.fromhex(dev_eui) for dev_eui, _ in usage}
+        tenants = {
+            row['dev_eui']: (row['tenant_id'], row['id'])
+            for row in await self.db_fetch(query, list(dev_euis))
+        }
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(
                 None,
                 publish_usage_event,
-                dev_eui, tenant_id, application_id, total_dc,
+                dev_eui, *tenants.get(dev_eui, (None, None)), total_dc,
             )
-        return
+            for dev_eui, total_dc in usage
+        ])
@@ -0,0 +1,210 @@
+import os
+import asyncio
+import logging
+import itertools
+
+import grpc
+from cachetools import TTLCache
+from chirpstack_api import api
+
+from Metrics import incr
+
+
+# -----------------------------------------------------------------------------
+# CHIRPSTACK GRPC CLIENT
+# -----------------------------------------------------------------------------
+# per-call deadline in seconds, calls made while the channel reconnects wait up to it.
+grpc_timeout = float(os.getenv('CHIRPSTACK_GRPC_TIMEOUT', 10))
+grpc_channels = int(os.getenv('CHIRPSTACK_GRPC_CHANNELS', 1))
+grpc_keepalive_ms = int(os.getenv('CHIRPSTACK_GRPC_KEEPALIVE_MS', 30_000))
+# items per page of a paged List call.
+list_page_size = int(os.getenv('CHIRPSTACK_LIST_PAGE_SIZE', 1000))
+# applications listed at once by `list_devices`.
+list_concurrency = int(os.getenv('CHIRPSTACK_LIST_CONCURRENCY', 8))
+
+channel_options = [
+    ('grpc.keepalive_time_ms', grpc_keepalive_ms),
+    ('grpc.keepalive_timeout_ms', 10_000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+    ('grpc.initial_reconnect_backoff_ms', 1_000),
+    ('grpc.max_reconnect_backoff_ms', 30_000),
+]
+
+# a call failing with these codes is retried once, the channel reconnects on its own.
+retry_codes = (grpc.StatusCode.UNAVAILABLE,)
+
+# least recently used devices are evicted past `device_cache_size`, entries expire after `device_cache_ttl`.
+device_cache_size = int(os.getenv('DEVICE_CACHE_SIZE', 50_000))
+device_cache_ttl = float(os.getenv('DEVICE_CACHE_TTL', 600))
+
+
+class DeviceCache(TTLCache):
+    """LRU cache with a ttl, counting hits, misses and evictions as `<name>:<stat>`.
+
+    Lookups in flight are kept in `fetching`, so a miss, or an uncached
+    `share`, for a device that is already being fetched waits on that call
+    instead of issuing its own.
+    """
+
+    def __init__(self, name: str, maxsize: int = device_cache_size, ttl: float = device_cache_ttl):
+        super().__init__(maxsize, ttl)
+        self.name = name
+        self.fetching = {}  # dev_eui -> lookup in flight, dropped on invalidate
+
+    def lookup(self, dev_eui: str):
+        value = self.get(dev_eui)
+        incr(f'{self.name}:miss' if value is None else f'{self.name}:hit')
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        incr(f'{self.name}:evicted')
+        return item
+
+    def invalidate(self, dev_eui: str):
+        self.fetching.pop(dev_eui, None)
+        if self.pop(dev_eui, None) is not None:
+            incr(f'{self.name}:invalidated')
+
+    async def fetch(self, dev_eui: str, call):
+        """Cached `call(dev_eui)`, a miss goes through `share`."""
+        value = self.lookup(dev_eui)
+        if value is not None:
+            return value
+        return await self.share(dev_eui, call)
+
+    async def share(self, dev_eui: str, call):
+        """`call(dev_eui)` past the cache, concurrent callers for the same device share one call.
+
+        The response is cached unless the device was invalidated while the
+        call was in flight, a caller arriving after that starts a new one.
+        """
+        future = self.fetching.get(dev_eui)
+        if future is not None:
+            incr(f'{self.name}:coalesced')
+            return await asyncio.shield(future)
+
+        future = self.fetching[dev_eui] = asyncio.ensure_future(call(dev_eui))
+        # retrieved even when every caller was cancelled.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            value = await asyncio.shield(future)
+        finally:
+            # invalidated while in flight the response may already be stale, it is not cached.
+            current = self.fetching.get(dev_eui) is future
+            if current:
+                del self.fetching[dev_eui]
+        if current:
+            self[dev_eui] = value
+        return value
+
+
+class ChirpstackClient:
+    """Long-lived gRPC channels to the ChirpStack API, shared by every class.
+
+    Created once in `main()` (per process) inside the running event loop
+    and closed on shutdown. Calls are spread round robin over
+    `grpc_channels` channels, carry the api token and a `grpc_timeout`
+    deadline, and wait for a reconnecting channel instead of failing fast.
+
+    Device and activation lookups are cached per dev_eui, the stream
+    handlers call `invalidate` on device updates and deletes, and drop
+    the activation on a join, so a cached entry is only served while it
+    is still current.
+    """
+
+    def __init__(self, host: str, token: str, channels: int = grpc_channels, timeout: float = grpc_timeout):
+        self.host = host
+        self.auth_token = [('authorization', f'Bearer {token}')]
+        self.timeout = timeout
+        self.channels = [
+            grpc.aio.insecure_channel(host, options=channel_options) for _ in range(max(1, channels))
+        ]
+        self.stubs = itertools.cycle([
+            {
+                'device': api.DeviceServiceStub(channel),
+                'application': api.ApplicationServiceStub(channel),
+                'tenant': api.TenantServiceStub(channel),
+            }
+            for channel in self.channels
+        ])
+        self.devices = DeviceCache('device_cache')
+        self.activations = DeviceCache('activation_cache')
+
+    async def call(self, method: str, req, service: str = 'device'):
+        """Call `<service>.<method>`, retrying once if the server was unavailable."""
+        stub = next(self.stubs)[service]
+        try:
+            return await getattr(stub, method)(
+                req, metadata=self.auth_token, timeout=self.timeout, wait_for_ready=True)
+        except grpc.aio.AioRpcError as err:
+            if err.code() not in retry_codes:
+                raise
+            logging.info(f'chirpstack {method}: {err.code().name}, retrying')
+        await asyncio.sleep(1)
+        return await getattr(next(self.stubs)[service], method)(
+            req, metadata=self.auth_token, timeout=self.timeout, wait_for_ready=True)
+
+    async def get_device(self, dev_eui: str) -> api.GetDeviceResponse:
+        return await self.devices.fetch(dev_eui, self.request_device)
+
+    async def get_device_activation(self, dev_eui: str) -> api.GetDeviceActivationResponse:
+        return await self.activations.fetch(dev_eui, self.request_device_activation)
+
+    # uncached reads, still sharing a call in flight for the same device.
+    async def fetch_device(self, dev_eui: str) -> api.GetDeviceResponse:
+        return await self.devices.share(dev_eui, self.request_device)
+
+    async def fetch_device_activation(self, dev_eui: str) -> api.GetDeviceActivationResponse:
+        return await self.activations.share(dev_eui, self.request_device_activation)
+
+    async def request_device(self, dev_eui: str) -> api.GetDeviceResponse:
+        req = api.GetDeviceRequest()
+        req.dev_eui = dev_eui
+        return await self.call('Get', req)
+
+    async def request_device_activation(self, dev_eui: str) -> api.GetDeviceActivationResponse:
+        req = api.GetDeviceActivationRequest()
+        req.dev_eui = dev_eui
+        return await self.call('GetActivation', req)
+
+    async def list_all(self, service: str, request, page_size: int = list_page_size, **filters) -> list:
+        """Every item of a paged `<service>.List`, the pages after the first are fetched concurrently."""
+        first = await self.call('List', request(limit=page_size, offset=0, **filters), service)
+        pages = await asyncio.gather(*[
+            self.call('List', request(limit=page_size, offset=offset, **filters), service)
+            for offset in range(page_size, first.total_count, page_size)
+        ])
+        return [item for page in (first, *pages) for item in page.result]
+
+    async def list_devices(self, tenant_id: str = None) -> list[api.DeviceListItem]:
+        """Every device of `tenant_id`, or of all tenants (needs an admin api key)."""
+        if tenant_id:
+            tenants = [tenant_id]
+        else:
+            tenants = [tenant.id for tenant in await self.list_all('tenant', api.ListTenantsRequest)]
+        applications = [
+            application.id
+            for applications in await asyncio.gather(*[
+                self.list_all('application', api.ListApplicationsRequest, tenant_id=tenant) for tenant in tenants
+            ])
+            for application in applications
+        ]
+        devices = []
+        # `list_concurrency` applications at a time, so a large deployment does not fan out unbounded.
+        for pos in range(0, len(applications), list_concurrency):
+            for listed in await asyncio.gather(*[
+                self.list_all('device', api.ListDevicesRequest, application_id=application)
+                for application in applications[pos:pos + list_concurrency]
+            ]):
+                devices.extend(listed)
+        return devices
+
+    def invalidate(self, dev_eui: str):
+        """Drop the cached device and activation of `dev_eui`."""
+        self.devices.invalidate(dev_eui)
+        self.activations.invalidate(dev_eui)
+
+    async def close(self):
+        await asyncio.gather(*[channel.close() for channel in self.channels])
@@ -0,0 +1,206 @@
+import os
+import time
+import asyncio
+import logging
+
+from RedisStreams import backoff
+
+
+# flush every `flush_interval` seconds or once `flush_size` uplinks are held.
+# keep the interval well below REDIS_RECLAIM_IDLE_MS so held entries are not reclaimed.
+flush_interval = float(os.getenv('DC_FLUSH_INTERVAL', 5))
+flush_size = int(os.getenv('DC_FLUSH_SIZE', 1000))
+# while flushes fail at most `held_max` uplinks are held, `add` then waits, holding up the stream reader.
+held_max = int(os.getenv('DC_HELD_MAX', 10_000))
+# applied stream ids are kept `applied_retention` seconds, an id only has to outlive the time until the
+# entries of its flush are acknowledged or redelivered. helium_stream_applied holds about uplinks per
+# second * retention rows, some 100 bytes each with the primary key.
+applied_retention = int(os.getenv('DC_APPLIED_RETENTION', 3600))
+# expired ids are deleted every `prune_interval` seconds, `prune_batch` rows per transaction.
+prune_interval = 300
+prune_batch = 10_000
+
+
+def stream_id(message_id) -> tuple[int, int]:
+    """Redis stream ids as comparable (milliseconds, sequence) pairs."""
+    if isinstance(message_id, bytes):
+        message_id = message_id.decode()
+    ms, seq = message_id.split('-')
+    return int(ms), int(seq)
+
+
+class DcAccumulator:
+    """Write-behind accumulator for the dc used by each device.
+
+    Uplinks are held in memory and written as one set-based UPDATE on a
+    timer or size threshold. A failed flush is retried on the timer with
+    backoff, and once `held_max` uplinks are held `add` waits for a flush
+    to get through, so the stream reader stops reading meanwhile. Every stream id applied is recorded in
+    `helium_stream_applied` by the same statement, and the dc of an id
+    already recorded is not added again. Entries are only acknowledged
+    after the flush commits, so an entry replayed after a crash, reclaimed
+    out of order, or claimed by another consumer or process while still
+    held here is counted once. Recorded ids expire after
+    `applied_retention` seconds and are pruned in batches outside the
+    flush.
+    """
+
+    def __init__(self, pool, dispatcher, stream_key: str, on_flush=None):
+        self.pool = pool
+        self.dispatcher = dispatcher
+        self.stream_key = stream_key
+        self.on_flush = on_flush
+        self.lock = asyncio.Lock()
+        self.failures = 0       # flushes failed in a row, retried on the timer with backoff
+        self.room = asyncio.Event()     # cleared while `held_max` uplinks are held
+        self.room.set()
+        self.table_ready = False
+        self.reset()
+
+    def reset(self):
+        self.entries = {}       # (ms, seq) -> (dev_eui, dc) per uplink
+        self.message_ids = []
+
+    async def create_table(self):
+        query = """
+            CREATE TABLE IF NOT EXISTS helium_stream_applied (
+                stream_key text,
+                ms bigint,
+                seq bigint,
+                primary key (stream_key, ms, seq)
+            );
+        """
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                await con.execute(query)
+        self.table_ready = True
+
+    async def add(self, consumer: str, usage: list[tuple[bytes, str, int]]):
+        """Accumulate `(message_id, dev_eui, dc)` entries delivered to `consumer`."""
+        while len(self.message_ids) >= held_max:
+            # the database is down, stop reading until a flush gets through.
+            self.room.clear()
+            await self.room.wait()
+        for message_id, dev_eui, total_dc in usage:
+            # held in flight so this dispatcher neither reclaims nor dead-letters it before the flush.
+            self.dispatcher.inflight.add((self.stream_key, message_id))
+            self.message_ids.append(message_id)
+            self.entries[stream_id(message_id)] = (dev_eui, total_dc)
+
+        # once a flush failed only the timer retries, not every batch read.
+        if len(self.message_ids) >= flush_size and not self.failures:
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.message_ids:
+                return
+            entries, message_ids = self.entries, self.message_ids
+            self.reset()
+            try:
+                applied = await self.commit(entries)
+            except Exception as exc:
+                self.failures += 1
+                logging.info(f'{self.stream_key} flush of {len(message_ids)} uplinks failed {self.failures} times: {exc}')
+                # keep everything held for the next flush, entries stay pending in redis.
+                self.entries = {**entries, **self.entries}
+                self.message_ids = message_ids + self.message_ids
+                return
+            self.failures = 0
+            self.room.set()
+
+            try:
+                await self.dispatcher.ack(self.stream_key, message_ids)
+            except Exception as exc:
+                # committed, a replay finds its ids recorded and is acknowledged then.
+                logging.info(f'{self.stream_key} ack after flush: {exc}')
+            finally:
+                self.dispatcher.inflight.difference_update((self.stream_key, m) for m in message_ids)
+            events = [entries[key] for key in applied]
+            skipped = f', {len(entries) - len(applied)} already applied' if len(entries) > len(applied) else ''
+            devices = len({dev_eui for dev_eui, _ in events})
+            logging.info(f'Flushed dc for {devices} devices from {len(events)} uplinks{skipped}')
+
+        if self.on_flush is not None and events:
+            try:
+                await self.on_flush(events)
+            except Exception as exc:
+                logging.info(f'{self.stream_key} on_flush: {exc}')
+
+    async def commit(self, entries: dict) -> list[tuple[int, int]]:
+        """Apply the dc of the entries not applied before, returns their ids."""
+        apply_dc = """
+            WITH entries AS (
+                SELECT * FROM unnest($2::bigint[], $3::bigint[], $4::text[], $5::int[]) AS e(ms, seq, dev_eui, dc)
+            ), applied AS (
+                INSERT INTO helium_stream_applied (stream_key, ms, seq)
+                SELECT $1, ms, seq FROM entries
+                ON CONFLICT DO NOTHING
+                RETURNING ms, seq
+            ), counted AS (
+                UPDATE helium_devices SET dc_used = (helium_devices.dc_used + usage.dc)
+                FROM (
+                    SELECT dev_eui, sum(dc) AS dc
+                    FROM entries JOIN applied USING (ms, seq)
+                    GROUP BY dev_eui
+                ) AS usage
+                WHERE helium_devices.dev_eui = usage.dev_eui
+            )
+            SELECT ms, seq FROM applied;
+        """
+        if not self.table_ready:
+            await self.create_table()
+        keys = list(entries)
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                rows = await con.fetch(
+                    apply_dc,
+                    self.stream_key,
+                    [ms for ms, _ in keys],
+                    [seq for _, seq in keys],
+                    [entries[key][0] for key in keys],
+                    [entries[key][1] for key in keys],
+                )
+        return [(row['ms'], row['seq']) for row in rows]
+
+    async def prune(self) -> int:
+        """Delete the applied ids older than `applied_retention`, `prune_batch` rows per transaction."""
+        query = """
+            DELETE FROM helium_stream_applied
+            WHERE (stream_key, ms, seq) IN (
+                SELECT stream_key, ms, seq FROM helium_stream_applied
+                WHERE stream_key=$1 AND ms < $2
+                LIMIT $3
+            );
+        """
+        if not self.table_ready:
+            await self.create_table()
+        expired = int((time.time() - applied_retention) * 1000)
+        pruned = 0
+        while True:
+            async with self.pool.acquire() as con:
+                async with con.transaction():
+                    status = await con.execute(query, self.stream_key, expired, prune_batch)
+            deleted = int(status.split()[-1])
+            pruned += deleted
+            if deleted < prune_batch:
+                return pruned
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(backoff(self.failures) if self.failures else flush_interval)
+            await self.flush()
+
+    async def prune_periodically(self):
+        while True:
+            await asyncio.sleep(prune_interval)
+            try:
+                pruned = await self.prune()
+            except Exception as exc:
+                logging.info(f'{self.stream_key} prune: {exc}')
+                continue
+            if pruned:
+                logging.info(f'Pruned {pruned} applied {self.stream_key} ids')
+
+    async def run(self):
+        await asyncio.gather(self.flush_periodically(), self.prune_periodically())
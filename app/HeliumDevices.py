@@ -0,0 +1,98 @@
+import os
+from typing import NamedTuple
+
+from Batcher import Batcher
+
+
+# concurrent upserts are batched for up to `device_write_wait` seconds or `device_write_batch` rows.
+device_write_batch = int(os.getenv('DEVICE_WRITE_BATCH', 500))
+device_write_wait = float(os.getenv('DEVICE_WRITE_WAIT', 0.05))
+
+
+class DeviceRecord(NamedTuple):
+    """One helium_devices row, fields in `upsert_devices` column order."""
+    dev_eui: str
+    join_eui: str
+    dev_addr: str
+    max_copies: int
+    aps_key: str
+    nws_key: str
+    dev_name: str
+    fcnt_up: int
+    fcnt_down: int
+
+
+def merged_record(device: dict, activation: dict) -> DeviceRecord:
+    """helium_devices row of a device and its activation, as MessageToDict returns them."""
+    devices = {
+        "devAddr": "",
+        "appSKey": "",
+        "nwkSEncKey": "",
+        "name": "",
+        "fCntUp": 0,
+        "nFCntDown": 0,
+    }
+    devices.update(device)
+    devices.update(activation)
+
+    max_copies = 0
+    if devices.get("variables") and "max_copies" in devices.get("variables"):
+        max_copies = int(devices["variables"]["max_copies"])
+    return DeviceRecord(
+        dev_eui=devices["devEui"],
+        join_eui=devices["joinEui"],
+        dev_addr=devices["devAddr"],
+        max_copies=max_copies,
+        aps_key=devices["appSKey"],
+        nws_key=devices["nwkSEncKey"],
+        dev_name=devices["name"],
+        fcnt_up=devices["fCntUp"],
+        fcnt_down=devices["nFCntDown"],
+    )
+
+
+async def upsert_devices(pool, records: list[DeviceRecord]):
+    """Upsert helium_devices rows with one statement."""
+    # a statement can only update a row once, the last record of a device wins.
+    records = list({record.dev_eui: record for record in records}.values())
+    query = """
+        INSERT INTO helium_devices
+        (dev_eui, join_eui, dev_addr, max_copies, aps_key, nws_key, dev_name, fcnt_up, fcnt_down)
+        SELECT * FROM unnest(
+            $1::text[], $2::text[], $3::text[], $4::int[], $5::text[],
+            $6::text[], $7::text[], $8::int[], $9::int[]
+        )
+        ON CONFLICT (dev_eui) DO UPDATE
+        SET join_eui = EXCLUDED.join_eui,
+            dev_addr = EXCLUDED.dev_addr,
+            max_copies = EXCLUDED.max_copies,
+            aps_key = EXCLUDED.aps_key,
+            nws_key = EXCLUDED.nws_key,
+            dev_name = EXCLUDED.dev_name,
+            fcnt_up = EXCLUDED.fcnt_up,
+            fcnt_down = EXCLUDED.fcnt_down;
+    """
+    async with pool.acquire() as con:
+        async with con.transaction():
+            await con.execute(query, *[list(column) for column in zip(*records)])
+
+
+class DeviceWriter(Batcher):
+    """Coalesce concurrent helium_devices upserts into one statement.
+
+    `write` returns once the batch holding its record has committed, or
+    raises what the batch raised, so callers keep per device error
+    handling while a sync pass or a join storm costs one transaction per
+    batch instead of one per device.
+    """
+
+    def __init__(self, pool):
+        super().__init__(device_write_batch, device_write_wait)
+        self.pool = pool
+
+    async def write(self, record: DeviceRecord):
+        await self.submit(record)
+
+    async def send(self, batch: list):
+        await upsert_devices(self.pool, [record for record, _ in batch])
+        self.settle(batch)
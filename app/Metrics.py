@@ -0,0 +1,35 @@
+import logging
+from collections import Counter
+
+
+# -----------------------------------------------------------------------------
+# PROCESS COUNTERS, logged periodically from app.py
+# -----------------------------------------------------------------------------
+counters = Counter()
+# latest snapshot from each ingest process, merged into the logged totals.
+remote = {}
+
+
+def incr(name: str, value: int = 1):
+    if value:
+        counters[name] += value
+
+
+def snapshot() -> dict[str, int]:
+    return dict(counters)
+
+
+def merge(source: str, counts: dict[str, int]):
+    """Replace the counters last reported by `source`, snapshots are cumulative."""
+    remote[source] = counts
+
+
+def totals() -> Counter:
+    total = Counter(counters)
+    for counts in remote.values():
+        total.update(counts)
+    return total
+
+
+async def log_metrics():
+    logging.info('metrics: ' + ', '.join(f'{k}={v}' for k, v in sorted(totals().items())))
@@ -0,0 +1,460 @@
+import os
+import time
+import zlib
+import random
+import asyncio
+import socket
+import logging
+import grpc
+import asyncpg
+import redis.asyncio as redis
+from grpclib import GRPCError
+from grpclib.const import Status
+from grpclib.exceptions import StreamTerminatedError
+
+from Metrics import incr
+
+
+# -----------------------------------------------------------------------------
+# CHIRPSTACK REDIS CONNECTION
+# -----------------------------------------------------------------------------
+redis_server = os.getenv('REDIS_HOST')
+rpool = redis.ConnectionPool(host=redis_server, port=6379, db=0)
+rdb = redis.Redis(connection_pool=rpool)
+
+# -----------------------------------------------------------------------------
+# CHIRPSTACK REDIS CONSUMER GROUP
+# -----------------------------------------------------------------------------
+consumer_group = os.getenv('REDIS_CONSUMER_GROUP') or 'chirpstack-hpr'
+consumer_name = os.getenv('REDIS_CONSUMER_NAME') or socket.gethostname()
+# where a newly created group starts, '$' new entries only, '0' replays the retained stream once.
+group_start_id = os.getenv('REDIS_GROUP_START_ID') or '$'
+reclaim_idle_ms = int(os.getenv('REDIS_RECLAIM_IDLE_MS', 60_000))
+reclaim_interval = int(os.getenv('REDIS_RECLAIM_INTERVAL', 30))
+# up to `batch_size` entries per stream per read, waiting at most `batch_wait_ms` for any to arrive.
+batch_size = int(os.getenv('STREAM_BATCH_SIZE', 100))
+batch_wait_ms = int(os.getenv('STREAM_BATCH_WAIT_MS', 1000))
+# partitioned handlers run on `stream_workers` workers, each with a queue of `stream_queue_size`.
+stream_workers = int(os.getenv('STREAM_WORKERS', 4))
+stream_queue_size = int(os.getenv('STREAM_QUEUE_SIZE', 1000))
+# a backlog of at least `catchup_threshold` entries is folded per device instead of replayed, 0 disables.
+catchup_threshold = int(os.getenv('STREAM_CATCHUP_THRESHOLD', 1000))
+catchup_page_size = int(os.getenv('STREAM_CATCHUP_PAGE_SIZE', 1000))
+# entries delivered `max_deliveries` times without being acknowledged move to `<stream_key>:dead`.
+max_deliveries = int(os.getenv('STREAM_MAX_DELIVERIES', 5))
+dead_letter_maxlen = int(os.getenv('STREAM_DEAD_LETTER_MAXLEN', 10_000))
+# exponential backoff on redis errors and outages, capped at `backoff_max` seconds.
+backoff_max = float(os.getenv('STREAM_BACKOFF_MAX', 30))
+
+# handler errors of an outage of postgres, the chirpstack api or the helium config service.
+outage_errors = (
+    OSError,
+    StreamTerminatedError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.TooManyConnectionsError,
+)
+outage_codes = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+outage_statuses = (Status.UNAVAILABLE, Status.DEADLINE_EXCEEDED)
+
+
+def is_outage(error) -> bool:
+    """True for a handler error that says nothing about the entry, retrying it later may succeed."""
+    if isinstance(error, outage_errors):
+        return True
+    if isinstance(error, grpc.aio.AioRpcError):
+        return error.code() in outage_codes
+    if isinstance(error, GRPCError):
+        return error.status in outage_statuses
+    return False
+
+
+def backoff(errors: int) -> float:
+    return min(backoff_max, 0.5 * 2 ** (errors - 1)) * random.uniform(0.5, 1)
+
+
+class StreamRoute:
+    """Handler registered for one stream key and field, see `StreamDispatcher.register`."""
+
+    __slots__ = ('handler', 'auto_ack', 'partition', 'accept', 'catch_up')
+
+    def __init__(self, handler, auto_ack=True, partition=None, accept=None, catch_up=None):
+        self.handler = handler
+        self.auto_ack = auto_ack
+        self.partition = partition
+        self.accept = accept
+        self.catch_up = catch_up
+
+
+class StreamDispatcher:
+    """Follow all chirpstack redis streams from one consumer group reader.
+
+    One XREADGROUP covers every registered stream key, entries are routed
+    by stream key and field and only acknowledged once handled, so a
+    restart resumes at the first unacknowledged entry. See `register`.
+    """
+
+    def __init__(
+        self,
+        rdb=rdb,
+        workers: int = stream_workers,
+        queue_size: int = stream_queue_size,
+        consumer: str = consumer_name,
+        catch_up: bool = True,
+    ):
+        # several dispatchers, in one or more processes, may share the group with a `consumer` name each.
+        # only one of them runs catch-up, the others start once its `ready` is set.
+        self.rdb = rdb
+        self.consumer = consumer
+        self.catch_up_streams = catch_up
+        self.ready = asyncio.Event()  # set once groups exist and any catch-up is done
+        self.handlers = {}  # stream_key -> {field: StreamRoute}
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        # (stream_key, message_id) queued, being handled or held for a flush. per process, another
+        # process sharing the group may still reclaim these, so handlers are idempotent per stream id.
+        self.inflight = set()
+        self.errors = {}  # (stream_key, message_id) -> last handler error
+
+    def register(
+        self,
+        stream_key: str,
+        field: bytes,
+        handler,
+        auto_ack: bool = True,
+        partition=None,
+        accept=None,
+        catch_up=None,
+    ):
+        """Hand the `field` entries of `stream_key` to `handler(batch, consumer)`.
+
+        The handler gets a batch of `(message_id, payload)` entries and the
+        consumer they were delivered to, and returns the ids it failed or
+        `{message_id: error}`, the rest are acknowledged with one XACK, or
+        by the handler through `ack` with `auto_ack=False`. With `partition`
+        (payload -> dev_eui) it runs on the workers, a device's entries in
+        order and a full queue blocking the reader. `accept` (payload ->
+        bool) is a pre-filter, rejected entries are acknowledged unhandled.
+        `catch_up` folds a startup backlog, see `catch_up`, failures are
+        retried as `handle` describes.
+        """
+        self.handlers.setdefault(stream_key, {})[field] = StreamRoute(
+            handler, auto_ack, partition, accept, catch_up)
+
+    async def create_groups(self):
+        for stream_key in self.handlers:
+            try:
+                await self.rdb.xgroup_create(
+                    stream_key, consumer_group, id=group_start_id, mkstream=True)
+            except redis.ResponseError as err:
+                # BUSYGROUP, group already exists so resume from its stored offset.
+                if 'BUSYGROUP' not in str(err):
+                    raise
+
+    async def ack(self, stream_key: str, message_ids: list):
+        if message_ids:
+            await self.rdb.xack(stream_key, consumer_group, *message_ids)
+
+    async def process(self, stream_key: str, messages: list, owner: str = None):
+        owner = owner or self.consumer
+        routes = self.handlers[stream_key]
+        batches = {}
+        unrouted = []
+        for message_id, fields in messages:
+            if (stream_key, message_id) in self.inflight:
+                # reclaimed while still waiting on a worker.
+                continue
+            # entries trimmed from the stream while still pending come back without fields.
+            field = next((f for f in fields or () if f in routes), None)
+            if field is None:
+                unrouted.append(message_id)
+            else:
+                batches.setdefault(field, []).append((message_id, fields[field]))
+        await self.ack(stream_key, unrouted)
+
+        for field, batch in batches.items():
+            route = routes[field]
+            if route.accept is not None:
+                batch = await self.prefilter(stream_key, batch, route.accept)
+                if not batch:
+                    continue
+            if route.partition is None:
+                await self.handle(stream_key, field, batch, owner)
+                continue
+            for message_id, payload in batch:
+                try:
+                    key = route.partition(payload)
+                except Exception as exc:
+                    # left pending, it is retried once reclaimed.
+                    self.failed(stream_key, {message_id: exc})
+                    continue
+                self.inflight.add((stream_key, message_id))
+                queue = self.queues[zlib.crc32(key.encode()) % len(self.queues)]
+                await queue.put((stream_key, field, owner, message_id, payload))
+
+    def split(self, stream_key: str, batch: list, accept) -> tuple[list, list]:
+        accepted = []
+        filtered = []
+        for message_id, payload in batch:
+            try:
+                keep = accept(payload)
+            except Exception:
+                # malformed, let the handler report it.
+                keep = True
+            (accepted if keep else filtered).append((message_id, payload))
+        incr(f'{stream_key}:filtered', len(filtered))
+        return accepted, filtered
+
+    async def prefilter(self, stream_key: str, batch: list, accept) -> list:
+        accepted, filtered = self.split(stream_key, batch, accept)
+        await self.ack(stream_key, [message_id for message_id, _ in filtered])
+        return accepted
+
+    def failed(self, stream_key: str, errors: dict):
+        for message_id, error in errors.items():
+            error = error if isinstance(error, str) else repr(error)
+            logging.info(f'{stream_key} {message_id}: {error}')
+            self.errors[(stream_key, message_id)] = error
+        while len(self.errors) > 10_000:
+            del self.errors[next(iter(self.errors))]
+        incr(f'{stream_key}:failed', len(errors))
+
+    async def handle(self, stream_key: str, field: bytes, batch: list, owner: str):
+        """Run the handler over `batch`, acknowledge what it processed and retry what an outage failed.
+
+        Entries failed by an outage (`is_outage`) are retried here with
+        backoff, holding up the worker or reader, and never use up a
+        delivery. Other failures stay pending for `reclaim`.
+        """
+        route = self.handlers[stream_key][field]
+        errors = 0
+        while True:
+            try:
+                failed = await route.handler(batch, owner) or {}
+            except Exception as exc:
+                if is_outage(exc):
+                    failed = {message_id: exc for message_id, _ in batch}
+                elif len(batch) > 1:
+                    # isolate the entry that broke the batch, the rest still go through.
+                    for entry in batch:
+                        await self.handle(stream_key, field, [entry], owner)
+                    return
+                else:
+                    # left pending, it is retried once reclaimed.
+                    self.failed(stream_key, {batch[0][0]: exc})
+                    return
+            if not isinstance(failed, dict):
+                failed = {message_id: 'handler reported failure' for message_id in failed}
+            outage = {message_id: error for message_id, error in failed.items() if is_outage(error)}
+            self.failed(stream_key, {m: e for m, e in failed.items() if m not in outage})
+            incr(f'{stream_key}:processed', len(batch) - len(failed))
+            if route.auto_ack:
+                done = [message_id for message_id, _ in batch if message_id not in failed]
+                for message_id in done:
+                    self.errors.pop((stream_key, message_id), None)
+                await self.ack(stream_key, done)
+            if not outage:
+                return
+
+            errors += 1
+            delay = backoff(errors)
+            logging.info(
+                f'{stream_key}: {len(outage)} entries failed on {next(iter(outage.values()))!r}, '
+                f'retrying in {delay:.1f}s')
+            incr(f'{stream_key}:retried', len(outage))
+            await asyncio.sleep(delay)
+            await self.touch(stream_key, list(outage))
+            batch = [entry for entry in batch if entry[0] in outage]
+
+    async def touch(self, stream_key: str, message_ids: list):
+        """Reset the idle time of entries still being retried, so no consumer reclaims them."""
+        try:
+            # JUSTID leaves the delivery count alone.
+            await self.rdb.xclaim(stream_key, consumer_group, self.consumer, 0, message_ids, justid=True)
+        except Exception as exc:
+            logging.info(f'{stream_key} touch: {exc}')
+
+    async def worker(self, queue: asyncio.Queue):
+        while True:
+            items = [await queue.get()]
+            while len(items) < batch_size and not queue.empty():
+                items.append(queue.get_nowait())
+
+            batches = {}
+            for stream_key, field, owner, message_id, payload in items:
+                batches.setdefault((stream_key, field, owner), []).append((message_id, payload))
+            for (stream_key, field, owner), batch in batches.items():
+                try:
+                    await self.handle(stream_key, field, batch, owner)
+                except Exception as exc:
+                    logging.info(f'{stream_key} worker: {exc}')
+                finally:
+                    self.inflight.difference_update((stream_key, message_id) for message_id, _ in batch)
+            for _ in items:
+                queue.task_done()
+
+    async def drain_pending(self):
+        """Re-process entries delivered to this consumer before a restart."""
+        for stream_key in self.handlers:
+            last_id = '0'
+            while True:
+                resp = await self.rdb.xreadgroup(
+                    consumer_group, self.consumer, {stream_key: last_id}, count=batch_size)
+                if not resp or not resp[0][1]:
+                    break
+                messages = resp[0][1]
+                last_id = messages[-1][0]
+                await self.process(stream_key, messages)
+
+    async def reclaim(self, stream_key: str):
+        """Claim entries idle for `reclaim_idle_ms` on any consumer, a failed handler's or a dead consumer's.
+
+        An entry delivered `max_deliveries` times is moved to the
+        `<stream_key>:dead` stream with its last error instead, so one bad
+        entry can not wedge the consumer.
+        """
+        pending = await self.rdb.xpending_range(
+            stream_key, consumer_group, min='-', max='+', count=batch_size, idle=reclaim_idle_ms)
+        # entries still queued or held by this process are not stuck.
+        pending = {
+            entry['message_id']: entry for entry in pending
+            if (stream_key, entry['message_id']) not in self.inflight
+        }
+        if not pending:
+            return
+        messages = await self.rdb.xclaim(
+            stream_key, consumer_group, self.consumer, reclaim_idle_ms, list(pending))
+        logging.info(f'{stream_key}: reclaimed {len(messages)} pending entries')
+        # handlers see the consumer each entry was first delivered to.
+        by_owner = {}
+        for message in filter(None, messages):
+            entry = pending.get(message[0])
+            if entry is None:
+                continue
+            owner = entry['consumer']
+            if isinstance(owner, bytes):
+                owner = owner.decode()
+            if entry['times_delivered'] >= max_deliveries and message[1]:
+                await self.dead_letter(stream_key, message, owner, entry['times_delivered'])
+                continue
+            by_owner.setdefault(owner, []).append(message)
+        for owner, claimed in by_owner.items():
+            await self.process(stream_key, claimed, owner)
+
+    async def dead_letter(self, stream_key: str, message: tuple, owner: str, deliveries: int):
+        message_id, fields = message
+        error = self.errors.pop((stream_key, message_id), 'unknown, failed on another consumer')
+        dead = {
+            **fields,
+            'dead_stream': stream_key,
+            'dead_id': message_id,
+            'dead_consumer': owner,
+            'dead_deliveries': deliveries,
+            'dead_error': error[:1000],
+            'dead_at': int(time.time() * 1000),
+        }
+        await self.rdb.xadd(f'{stream_key}:dead', dead, maxlen=dead_letter_maxlen, approximate=True)
+        await self.ack(stream_key, [message_id])
+        incr(f'{stream_key}:dead_lettered')
+        logging.error(f'{stream_key} {message_id}: dead-lettered after {deliveries} deliveries, {error}')
+
+    async def backlog(self, stream_key: str, field: bytes, route: StreamRoute, start: str, end: str):
+        """Pages of the entries after `start` up to `end`, read with XRANGE."""
+        while start != end:
+            messages = await self.rdb.xrange(stream_key, min=f'({start}', max=end, count=catchup_page_size)
+            if not messages:
+                return
+            start = messages[-1][0].decode()
+            page = [(message_id, fields[field]) for message_id, fields in messages if field in fields]
+            if route.accept is not None:
+                page, _ = self.split(stream_key, page, route.accept)
+            incr(f'{stream_key}:caught_up', len(messages))
+            yield page
+            self.caught_up = start
+
+    async def catch_up(self, stream_key: str):
+        """Fold a backlog of `catchup_threshold` or more entries per device instead of replaying it.
+
+        Only for a stream with a single route that has a `catch_up` handler.
+        It is given the backlog as an async iterator of XRANGE pages and
+        returns `{message_id: error}` for what it could not apply, those are
+        dead-lettered, then the group is moved past the backlog.
+        """
+        routes = self.handlers[stream_key]
+        if len(routes) != 1:
+            return
+        field, route = next(iter(routes.items()))
+        if route.catch_up is None or catchup_threshold <= 0:
+            return
+
+        groups = await self.rdb.xinfo_groups(stream_key)
+        group = next(g for g in groups if g['name'] in (consumer_group, consumer_group.encode()))
+        # lag is unknown (None) after the stream was trimmed past the group or on redis < 7.
+        lag = group.get('lag')
+        if lag is not None and lag < catchup_threshold:
+            return
+        start = group['last-delivered-id'].decode()
+        end = (await self.rdb.xinfo_stream(stream_key))['last-generated-id'].decode()
+        if start == end:
+            return
+
+        print(f'Catch-up {stream_key}: backlog of {lag if lag is not None else "unknown"} entries')
+        self.caught_up = start
+        try:
+            failed = await route.catch_up(self.backlog(stream_key, field, route, start, end))
+        except Exception as exc:
+            # anything not applied is delivered to the handler as usual.
+            logging.info(f'{stream_key} catch-up: {exc}')
+            return
+        if any(is_outage(error) for error in failed.values()):
+            # an outage is no reason to give up on an entry, the backlog is delivered as usual instead.
+            logging.info(f'{stream_key} catch-up: {len(failed)} devices failed during an outage, replaying')
+            return
+        if failed:
+            # never delivered, so nothing would retry them once the group moves past.
+            self.failed(stream_key, failed)
+            for message_id in failed:
+                for message in await self.rdb.xrange(stream_key, min=message_id, max=message_id):
+                    await self.dead_letter(stream_key, message, self.consumer, 0)
+        # catch-up entries are never delivered, so moving the group leaves nothing pending.
+        await self.rdb.xgroup_setid(stream_key, consumer_group, self.caught_up)
+        print(f'Catch-up {stream_key}: done up to {self.caught_up}')
+
+    async def read(self):
+        started = False
+        next_reclaim = 0
+        errors = 0
+        while True:
+            try:
+                if not started:
+                    await self.create_groups()
+                    await self.drain_pending()
+                    if self.catch_up_streams:
+                        for stream_key in self.handlers:
+                            await self.catch_up(stream_key)
+                    started = True
+                    self.ready.set()
+
+                if time.monotonic() >= next_reclaim:
+                    for stream_key in self.handlers:
+                        await self.reclaim(stream_key)
+                    next_reclaim = time.monotonic() + reclaim_interval
+
+                resp = await self.rdb.xreadgroup(
+                    consumer_group,
+                    self.consumer,
+                    {stream_key: '>' for stream_key in self.handlers},
+                    count=batch_size,
+                    block=batch_wait_ms,
+                )
+                for stream_key, messages in resp or []:
+                    await self.process(stream_key.decode(), messages)
+                errors = 0
+
+            except Exception as exc:
+                errors += 1
+                delay = backoff(errors)
+                logging.info(f'stream dispatcher: {exc}, retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
+
+    async def run(self):
+        await asyncio.gather(self.read(), *[self.worker(queue) for queue in self.queues])
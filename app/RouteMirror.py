@@ -0,0 +1,328 @@
+import os
+import time
+import random
+import asyncio
+import logging
+
+from grpclib import GRPCError
+from grpclib.const import Cardinality, Status
+
+from protos.helium import iot_config
+from ChirpHeliumCrypto import HeliumChannel, helium_timeout, route_call, signed
+from Metrics import incr
+from RouteSkf import Skf
+
+
+# mirror writes are flushed to postgres every `mirror_flush_interval` seconds or `mirror_flush_size` changes.
+mirror_flush_interval = float(os.getenv('ROUTE_MIRROR_FLUSH_INTERVAL', 1))
+mirror_flush_size = int(os.getenv('ROUTE_MIRROR_FLUSH_SIZE', 1000))
+# a stream that stayed up this long, or delivered an update, resets the reconnect backoff.
+mirror_stable_after = 300
+mirror_backoff_max = 600
+# the delegate key may not subscribe, or the config service has no route stream.
+mirror_fatal = (Status.PERMISSION_DENIED, Status.UNIMPLEMENTED)
+
+mirror_tables = {
+    'helium_route_skfs': """
+        devaddr bigint,
+        session_key bytea,
+        max_copies int default 0,
+        primary key (devaddr, session_key)
+    """,
+    'helium_route_euis': """
+        app_eui text,
+        dev_eui text,
+        primary key (app_eui, dev_eui)
+    """,
+    'helium_route_devaddr_ranges': """
+        start_addr bigint,
+        end_addr bigint,
+        primary key (start_addr, end_addr)
+    """,
+}
+
+
+async def copy_listing(pool, table: str, listing, batch_size: int = mirror_flush_size) -> int:
+    """Copy the rows `listing(route_stub)` yields into `table` through `route_call`, returns their count.
+
+    Each batch is copied on a connection of its own, none is held while
+    the listing streams.
+    """
+    async def copy(batch: list):
+        async with pool.acquire() as con:
+            await con.copy_records_to_table(table, records=batch)
+
+    async def call(service: iot_config.RouteStub):
+        # a retried listing starts over.
+        async with pool.acquire() as con:
+            await con.execute(f'TRUNCATE {table};')
+        count = 0
+        batch = []
+        async for row in listing(service):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                await copy(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            await copy(batch)
+            count += len(batch)
+        return count
+
+    return await route_call(call)
+
+
+def skf_listing(route_id: str):
+    """`list_skfs` of `route_id` as `Skf.record()` rows, for `copy_listing`."""
+    def listing(service: iot_config.RouteStub):
+        req = signed(iot_config.RouteSkfListReqV1(route_id=route_id))
+        # the whole listing streams within one call, allow it longer than a single update.
+        return (Skf.from_proto(skf).record() async for skf in service.list_skfs(req, timeout=service.timeout * 10))
+    return listing
+
+
+class RouteMirror:
+    """Mirror of our route's skfs, eui pairs and devaddr ranges in the `helium_route_*` tables.
+
+    `run` subscribes to the config service `route/stream` first, waits
+    for the stream to open and buffers its updates while the list calls
+    load the route, then applies
+    the buffer and every update after it. Removes sent while the stream
+    was down would be missed, so the route is loaded again on every
+    reconnect. Nothing but the pending writes is held in memory.
+
+    The stream runs on a channel of its own, so a failed call on the
+    shared channel never takes it down. A delegate key that may not
+    subscribe disables the mirror, reconciliation then keeps listing.
+    """
+
+    def __init__(self, pool, route_id: str):
+        self.pool = pool
+        self.route_id = route_id
+        self.helium = HeliumChannel()
+        self.dirty = {'skfs': {}, 'euis': {}, 'ranges': {}}  # key -> latest row, or None when removed
+        self.synced = asyncio.Event()  # set once the tables hold the route
+        self.lock = asyncio.Lock()      # a flush never interleaves with a resync's table swap
+        self.delivered = False          # the current stream delivered an update
+
+    async def execute(self, query: str, *params):
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                await con.execute(query, *params)
+
+    async def create_tables(self):
+        for table, columns in mirror_tables.items():
+            await self.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} ({columns});
+                CREATE UNLOGGED TABLE IF NOT EXISTS {table}_load (LIKE {table});
+            """)
+
+    ###########################################################################
+    # full load with the list calls
+    ###########################################################################
+    async def resync(self):
+        def list_euis(service: iot_config.RouteStub):
+            req = signed(iot_config.RouteGetEuisReqV1(route_id=self.route_id))
+            return (
+                (f'{pair.app_eui:016x}', f'{pair.dev_eui:016x}')
+                async for pair in service.get_euis(req, timeout=service.timeout * 10)
+            )
+
+        def list_ranges(service: iot_config.RouteStub):
+            req = signed(iot_config.RouteGetDevaddrRangesReqV1(route_id=self.route_id))
+            return (
+                (devaddr_range.start_addr, devaddr_range.end_addr)
+                async for devaddr_range in service.get_devaddr_ranges(req)
+            )
+
+        skfs = await copy_listing(self.pool, 'helium_route_skfs_load', skf_listing(self.route_id))
+        euis = await copy_listing(self.pool, 'helium_route_euis_load', list_euis)
+        ranges = await copy_listing(self.pool, 'helium_route_devaddr_ranges_load', list_ranges)
+        async with self.lock:
+            # buffered stream updates are applied over the new tables, older pending writes are moot.
+            self.dirty = {'skfs': {}, 'euis': {}, 'ranges': {}}
+            await self.execute(''.join(
+                f'TRUNCATE {table}; INSERT INTO {table} SELECT * FROM {table}_load ON CONFLICT DO NOTHING; '
+                f'TRUNCATE {table}_load;'
+                for table in mirror_tables
+            ))
+        print(f'Route mirror: {skfs} skfs, {euis} euis, {ranges} devaddr ranges')
+
+    ###########################################################################
+    # route stream updates
+    ###########################################################################
+    def apply(self, res: iot_config.RouteStreamResV1):
+        """Queue one stream update for the tables, written on the next flush."""
+        add = res.action == iot_config.ActionV1.add
+        if res.skf.route_id == self.route_id:
+            skf = Skf.from_proto(res.skf)
+            self.dirty['skfs'][skf] = skf if add else None
+        elif res.eui_pair.route_id == self.route_id:
+            key = (f'{res.eui_pair.app_eui:016x}', f'{res.eui_pair.dev_eui:016x}')
+            self.dirty['euis'][key] = key if add else None
+        elif res.devaddr_range.route_id == self.route_id:
+            key = (res.devaddr_range.start_addr, res.devaddr_range.end_addr)
+            self.dirty['ranges'][key] = key if add else None
+        else:
+            return
+        incr('route_mirror:updates')
+
+    async def flush(self):
+        async with self.lock:
+            await self.write_dirty()
+
+    async def write_dirty(self):
+        dirty, self.dirty = self.dirty, {'skfs': {}, 'euis': {}, 'ranges': {}}
+        if not any(dirty.values()):
+            return
+        added = {kind: [v for v in rows.values() if v is not None] for kind, rows in dirty.items()}
+        removed = {kind: [k for k, v in rows.items() if v is None] for kind, rows in dirty.items()}
+        try:
+            async with self.pool.acquire() as con:
+                async with con.transaction():
+                    await con.execute(
+                        """
+                        INSERT INTO helium_route_skfs SELECT * FROM unnest($1::bigint[], $2::bytea[], $3::int[])
+                        ON CONFLICT (devaddr, session_key) DO UPDATE SET max_copies = EXCLUDED.max_copies;
+                        """,
+                        [skf.devaddr for skf in added['skfs']],
+                        [skf.key for skf in added['skfs']],
+                        [skf.max_copies for skf in added['skfs']],
+                    )
+                    await con.execute(
+                        """
+                        DELETE FROM helium_route_skfs USING unnest($1::bigint[], $2::bytea[]) AS r(devaddr, session_key)
+                        WHERE helium_route_skfs.devaddr = r.devaddr AND helium_route_skfs.session_key = r.session_key;
+                        """,
+                        [skf.devaddr for skf in removed['skfs']],
+                        [skf.key for skf in removed['skfs']],
+                    )
+                    await con.execute(
+                        """
+                        INSERT INTO helium_route_euis SELECT * FROM unnest($1::text[], $2::text[])
+                        ON CONFLICT DO NOTHING;
+                        """,
+                        [app_eui for app_eui, _ in added['euis']],
+                        [dev_eui for _, dev_eui in added['euis']],
+                    )
+                    await con.execute(
+                        """
+                        DELETE FROM helium_route_euis USING unnest($1::text[], $2::text[]) AS r(app_eui, dev_eui)
+                        WHERE helium_route_euis.app_eui = r.app_eui AND helium_route_euis.dev_eui = r.dev_eui;
+                        """,
+                        [app_eui for app_eui, _ in removed['euis']],
+                        [dev_eui for _, dev_eui in removed['euis']],
+                    )
+                    await con.execute(
+                        """
+                        INSERT INTO helium_route_devaddr_ranges SELECT * FROM unnest($1::bigint[], $2::bigint[])
+                        ON CONFLICT DO NOTHING;
+                        """,
+                        [start for start, _ in added['ranges']],
+                        [end for _, end in added['ranges']],
+                    )
+                    await con.execute(
+                        """
+                        DELETE FROM helium_route_devaddr_ranges
+                        USING unnest($1::bigint[], $2::bigint[]) AS r(start_addr, end_addr)
+                        WHERE helium_route_devaddr_ranges.start_addr = r.start_addr
+                        AND helium_route_devaddr_ranges.end_addr = r.end_addr;
+                        """,
+                        [start for start, _ in removed['ranges']],
+                        [end for _, end in removed['ranges']],
+                    )
+        except Exception as exc:
+            logging.info(f'route mirror flush: {exc}')
+            # newer changes win over the ones that failed to write.
+            for kind, rows in dirty.items():
+                self.dirty[kind] = {**rows, **self.dirty[kind]}
+
+    async def subscribe(self, updates: asyncio.Queue, opened: asyncio.Event):
+        """Put every stream update on `updates`, then None when it ends or the error it failed with.
+
+        `opened` is set once the config service sent the stream's headers,
+        every change made after that is delivered.
+        """
+        try:
+            # requested on the channel, the generated stub can not wait for the headers.
+            # a stream stays open indefinitely, so no per-call deadline.
+            async with self.helium.route().channel.request(
+                '/helium.iot_config.route/stream',
+                Cardinality.UNARY_STREAM,
+                iot_config.RouteStreamReqV1,
+                iot_config.RouteStreamResV1,
+            ) as stream:
+                await stream.send_message(signed(iot_config.RouteStreamReqV1()), end=True)
+                await stream.recv_initial_metadata()
+                opened.set()
+                async for res in stream:
+                    updates.put_nowait(res)
+        except Exception as exc:
+            updates.put_nowait(exc)
+            return
+        updates.put_nowait(None)
+
+    async def follow(self):
+        """Subscribe, load the route once the stream is open, then apply the stream until it ends or fails."""
+        updates = asyncio.Queue()
+        opened = asyncio.Event()
+        stream = asyncio.create_task(self.subscribe(updates, opened))
+        try:
+            waiter = asyncio.create_task(opened.wait())
+            await asyncio.wait([waiter, stream], timeout=helium_timeout, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if not opened.is_set():
+                if stream.done():
+                    raise updates.get_nowait() or ConnectionError('route stream ended before it opened')
+                raise TimeoutError(f'route stream not open after {helium_timeout}s')
+            await self.resync()
+            while True:
+                if updates.empty() and not self.synced.is_set():
+                    # the updates buffered while the route loaded are applied, the tables are current.
+                    self.synced.set()
+                res = await updates.get()
+                if res is None:
+                    return
+                if isinstance(res, Exception):
+                    raise res
+                self.delivered = True
+                self.apply(res)
+                if sum(len(rows) for rows in self.dirty.values()) >= mirror_flush_size:
+                    await self.flush()
+        finally:
+            stream.cancel()
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(mirror_flush_interval)
+            await self.flush()
+
+    async def run(self):
+        await self.create_tables()
+        flusher = asyncio.create_task(self.flush_periodically())
+        errors = 0
+        try:
+            while True:
+                started = time.monotonic()
+                self.delivered = False
+                try:
+                    await self.follow()
+                    logging.info('route mirror: stream ended, resyncing')
+                except GRPCError as err:
+                    if err.status in mirror_fatal:
+                        logging.error(f'route mirror: {err.status.name}, disabled, reconciliation keeps listing skfs')
+                        return
+                    logging.info(f'route mirror: {err!r}')
+                except Exception as exc:
+                    logging.info(f'route mirror: {exc!r}')
+                # reconciliation falls back to list_skfs until the mirror is resynced.
+                self.synced.clear()
+                self.helium.close()
+                if self.delivered or time.monotonic() - started >= mirror_stable_after:
+                    errors = 0
+                errors += 1
+                await asyncio.sleep(min(mirror_backoff_max, 2 ** errors) * random.uniform(0.5, 1))
+        finally:
+            flusher.cancel()
+            self.synced.clear()
+            self.helium.close()
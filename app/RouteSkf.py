@@ -0,0 +1,71 @@
+from protos.helium import iot_config
+
+
+class Skf:
+    """One session key filter of a route: devaddr, 16 byte session key, max_copies.
+
+    Kept as an int, bytes and a small int instead of the dict of hex
+    strings `to_dict()` gives, and only turned back into hex when an update
+    is sent. Equal and hashed by devaddr and key, so a set holds one entry
+    per session whatever its max_copies.
+    """
+
+    __slots__ = ('devaddr', 'key', 'max_copies')
+
+    def __init__(self, devaddr: int, key: bytes, max_copies: int = 0):
+        self.devaddr = devaddr
+        self.key = key
+        self.max_copies = max_copies
+
+    @classmethod
+    def from_proto(cls, skf: iot_config.SkfV1) -> 'Skf':
+        return cls(skf.devaddr, bytes.fromhex(skf.session_key), skf.max_copies)
+
+    @classmethod
+    def of_session(cls, dev_addr: str, nws_key: str, max_copies: int = 0) -> 'Skf | None':
+        """Skf of a helium_devices session, None for a device that has not joined."""
+        if not dev_addr or not nws_key:
+            return None
+        return cls(int(dev_addr, 16), bytes.fromhex(nws_key), max_copies or 0)
+
+    @property
+    def session_key(self) -> str:
+        return self.key.hex()
+
+    def record(self) -> tuple[int, bytes, int]:
+        """Row of a `(devaddr bigint, session_key bytea, max_copies int)` table."""
+        return self.devaddr, self.key, self.max_copies
+
+    def update(self, action: iot_config.ActionV1) -> iot_config.RouteSkfUpdateReqV1RouteSkfUpdateV1:
+        return iot_config.RouteSkfUpdateReqV1RouteSkfUpdateV1(
+            devaddr=self.devaddr,
+            session_key=self.session_key,
+            action=action,
+            max_copies=self.max_copies,
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, Skf):
+            return NotImplemented
+        return self.devaddr == other.devaddr and self.key == other.key
+
+    def __hash__(self):
+        return hash((self.devaddr, self.key))
+
+    def __repr__(self):
+        return f'Skf({self.devaddr:08x}, {self.session_key}, max_copies={self.max_copies})'
+
+
+def session_updates(previous: Skf | None, current: Skf | None) -> list:
+    """Updates moving a device from its previous session to its current one.
+
+    Sent as one `update_device_skfs` request, the old devaddr/key is
+    removed ahead of the add. Adds are idempotent, so the current session
+    is always added.
+    """
+    updates = []
+    if previous is not None and previous != current:
+        updates.append(previous.update(iot_config.ActionV1.remove))
+    if current is not None:
+        updates.append(current.update(iot_config.ActionV1.add))
+    return updates
@@ -0,0 +1,130 @@
+from math import ceil
+from chirpstack_api import stream, integration
+
+
+###########################################################################
+# decode only the fields the stream handlers use, straight off the protobuf
+# messages instead of building a camel-cased dict with MessageToDict.
+###########################################################################
+def decode_uplink_meta(raw: bytes) -> tuple[str, int, int]:
+    """Return `(dev_eui, dupes, dc)` for a `stream:meta` `up` entry."""
+    pl = stream.meta_pb2.UplinkMeta()
+    pl.ParseFromString(raw)
+    # an empty msg sent by a device has no application payload, fall back to phy payload.
+    byte_count = pl.application_payload_byte_count or pl.phy_payload_byte_count
+    return pl.dev_eui, len(pl.rx_info), ceil(byte_count / 24)
+
+
+def decode_join_event(raw: bytes) -> str:
+    """Return the dev_eui of a `device:stream:event` `join` entry."""
+    pl = integration.integration_pb2.JoinEvent()
+    pl.ParseFromString(raw)
+    return pl.device_info.dev_eui
+
+
+def decode_api_request(raw: bytes):
+    """Return the parsed `ApiRequestLog` of an `api:stream:request` entry.
+
+    `service`, `method` and `metadata` are read as attributes, metadata is
+    a str -> str map with the same keys as the MessageToDict output.
+    """
+    pl = stream.api_request_pb2.ApiRequestLog()
+    pl.ParseFromString(raw)
+    return pl
+
+
+def _varint(raw: bytes, pos: int) -> tuple[int, int]:
+    result = shift = 0
+    while True:
+        b = raw[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def api_request_route(raw: bytes) -> tuple[str, str]:
+    """Read `(service, method)` of an `ApiRequestLog` off the wire.
+
+    Fields are serialized in field number order, so scanning stops after
+    service (1) and method (2) without ever touching the metadata map.
+    """
+    service = method = ''
+    pos = 0
+    while pos < len(raw) and not (service and method):
+        tag, pos = _varint(raw, pos)
+        field, wire_type = tag >> 3, tag & 7
+        if wire_type == 2:
+            size, pos = _varint(raw, pos)
+            if field == 1:
+                service = raw[pos:pos + size].decode()
+            elif field == 2:
+                method = raw[pos:pos + size].decode()
+            pos += size
+        elif wire_type == 0:
+            _, pos = _varint(raw, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError(f'unsupported wire type {wire_type}')
+    return service, method
+
+
+def is_device_change(raw: bytes) -> bool:
+    """Pre-filter for `api:stream:request`, only DeviceService Create/Update/Delete."""
+    service, method = api_request_route(raw)
+    return service == 'api.DeviceService' and method in ('Create', 'Update', 'Delete')
+
+
+def api_request_dev_eui(raw: bytes) -> str:
+    """Partition key of an `api:stream:request` entry, empty if it has no dev_eui."""
+    return decode_api_request(raw).metadata.get('dev_eui', '')
+
+
+###########################################################################
+# chirpstack stores the device session as an internal.DeviceSession
+# protobuf in `device.device_session` (v4.7+). chirpstack_api does not ship
+# the internal protos, so the few fields the device sync needs are read
+# off the wire, field numbers as in chirpstack's internal.proto.
+###########################################################################
+def _fields(raw: bytes) -> dict[int, bytes | int]:
+    """Top level fields of a protobuf message, the last occurrence wins."""
+    fields = {}
+    pos = 0
+    while pos < len(raw):
+        tag, pos = _varint(raw, pos)
+        field, wire_type = tag >> 3, tag & 7
+        if wire_type == 2:
+            size, pos = _varint(raw, pos)
+            fields[field] = raw[pos:pos + size]
+            pos += size
+        elif wire_type == 0:
+            fields[field], pos = _varint(raw, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError(f'unsupported wire type {wire_type}')
+    return fields
+
+
+def decode_device_session(raw: bytes) -> tuple[str, str, str, int, int]:
+    """Return `(dev_addr, nwk_s_enc_key, app_s_key, f_cnt_up, n_f_cnt_down)` as GetActivation has them.
+
+    Keys are lower case hex, app_s_key is the `aes_key` of its key
+    envelope (field 7). f_cnt_up is field 8 and n_f_cnt_down field 9,
+    field 10 is a_f_cnt_down.
+    """
+    fields = _fields(raw)
+    app_s_key = _fields(fields.get(7, b'')).get(2, b'')
+    return (
+        fields.get(2, b'').hex(),
+        fields.get(6, b'').hex(),
+        app_s_key.hex(),
+        fields.get(8, 0),
+        fields.get(9, 0),
+    )
@@ -1,6 +1,8 @@
 import os
+import queue
 import asyncio
 import logging
+import multiprocessing
 import time
 
 from DatabasePool import Database
@@ -8,10 +10,22 @@ from ChirpHeliumRequestsRpc import ChirpstackStreams
 from ChirpHeliumKeysRpc import ChirpDeviceKeys
 from ChirpHeliumTenant import ChirpstackTenant
 from ChirpHeliumJoinRpc import ChirpstackJoins
+from ChirpstackClient import ChirpstackClient
+from ChirpHeliumCrypto import helium_channel
+from RouteMirror import RouteMirror
+from RedisStreams import StreamDispatcher, consumer_name
+from Metrics import log_metrics, merge, snapshot
 
 
 logging.basicConfig(level=logging.INFO)
 
+# processes sharing the redis consumer group for stream:meta and device:stream:event,
+# 1 runs everything in a single process.
+ingest_processes = int(os.getenv('INGEST_PROCESSES', 1))
+metrics_int = int(os.getenv('METRICS_INTERVAL', 60))
+# joins, disables and deletes update the route's skfs as they happen, the full skf sweep is a safety net.
+skfs_int = int(os.getenv('HELIUM_SKF_SWEEP_INTERVAL', 3600))
+
 
 def build_dsn() -> str:
     user = os.getenv('POSTGRES_USER')
@@ -37,6 +51,86 @@ async def run_periodically(coro_fn, interval: int, name: str):
         await asyncio.sleep(max(0, interval - elapsed))
 
 
+def ingest_process(index: int, metrics):
+    """Entry point of ingest process `index`, started by `supervise`."""
+    asyncio.run(ingest(index, metrics))
+
+
+async def ingest(index: int, metrics):
+    """Consume stream:meta and device:stream:event as consumer `<name>-<index>`.
+
+    Redis spreads entries over every consumer in the group, so each process
+    decodes, accumulates and flushes its own share. Catch-up and periodic
+    jobs stay with the supervisor. Entries another process holds past
+    REDIS_RECLAIM_IDLE_MS, during a long database outage say, can be
+    reclaimed here, the dc flush records applied stream ids so they are
+    still counted once and joins only re-push the same session.
+    """
+    route_id = os.getenv('ROUTE_ID')
+    chirpstack_host = os.getenv('CHIRPSTACK_SERVER')
+    chirpstack_token = os.getenv('CHIRPSTACK_APIKEY')
+
+    db = Database(build_dsn())
+    await db.connect()
+    chirpstack = ChirpstackClient(chirpstack_host, chirpstack_token)
+
+    events = ChirpstackJoins(route_id, db.pool, chirpstack)
+    tenant = ChirpstackTenant(route_id, db.pool, chirpstack)
+
+    dispatcher = StreamDispatcher(consumer=f'{consumer_name}-{index}', catch_up=False)
+    events.device_stream_event(dispatcher)
+    tenant.stream_meta(dispatcher)
+
+    async def report_metrics():
+        metrics.put((dispatcher.consumer, snapshot()))
+
+    try:
+        await asyncio.gather(
+            dispatcher.run(),
+            tenant.accumulator.run(),
+            run_periodically(report_metrics, metrics_int, 'report_metrics'),
+        )
+    finally:
+        helium_channel.close()
+        await chirpstack.close()
+        await db.close()
+
+
+async def supervise(dispatcher: StreamDispatcher, count: int):
+    """Run `count` ingest processes, restarting any that exit, and merge their metrics.
+
+    Processes are only started once the supervisor's own dispatcher is
+    ready, so catch-up has moved the groups before anyone else reads.
+    """
+    await dispatcher.ready.wait()
+    ctx = multiprocessing.get_context('spawn')
+    metrics = ctx.Queue()
+    processes = {}
+    try:
+        while True:
+            for index in range(count):
+                process = processes.get(index)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    print(f'Ingest process {index} exited with {process.exitcode}, restarting')
+                process = ctx.Process(
+                    target=ingest_process, args=(index, metrics), name=f'ingest-{index}', daemon=True)
+                process.start()
+                processes[index] = process
+            while True:
+                try:
+                    merge(*metrics.get_nowait())
+                except queue.Empty:
+                    break
+            await asyncio.sleep(5)
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join(5)
+
+
 async def main():
     route_id = os.getenv('ROUTE_ID')
     chirpstack_host = os.getenv('CHIRPSTACK_SERVER')
@@ -44,38 +138,47 @@ async def main():
 
     db = Database(build_dsn())
     await db.connect()
+    # one set of long-lived grpc channels, shared by every class.
+    chirpstack = ChirpstackClient(chirpstack_host, chirpstack_token)
+
+    events = ChirpstackJoins(route_id, db.pool, chirpstack)
+    client_streams = ChirpstackStreams(route_id, db.pool, chirpstack)
+    # follow the config service route stream so skfs are diffed locally instead of listed every pass.
+    mirror = RouteMirror(db.pool, route_id) if os.getenv('HELIUM_ROUTE_MIRROR') == 'True' else None
+    client_keys = ChirpDeviceKeys(route_id, db.pool, chirpstack, mirror)
+    tenant = ChirpstackTenant(route_id, db.pool, chirpstack)
 
-    events = ChirpstackJoins(
-        route_id, db.pool, chirpstack_host, chirpstack_token)
-    client_streams = ChirpstackStreams(
-        route_id, db.pool, chirpstack_host, chirpstack_token)
-    client_keys = ChirpDeviceKeys(
-        route_id, db.pool, chirpstack_host, chirpstack_token)
-    tenant = ChirpstackTenant(
-        route_id, db.pool, chirpstack_host, chirpstack_token)
-
-    async def update_device_status():
-        updates = []
-        for dev_eui in await client_keys.fetch_all_devices():
-            updates.append(await client_keys.get_merged_keys(dev_eui))
-        print('\n'.join(updates))
-
-    skfs_int = 60 * 5   # 5 minutes
     device_int = 60 * 5  # 5 minutes
 
     await client_streams.create_tables()
 
+    # one reader for every chirpstack stream, routed by stream key and field.
+    dispatcher = StreamDispatcher()
+    client_streams.api_stream_requests(dispatcher)
+    events.device_stream_event(dispatcher)
+    if ingest_processes > 1:
+        # stream:meta is left to the ingest processes, api requests stay here to keep their order.
+        ingest = supervise(dispatcher, ingest_processes)
+    else:
+        tenant.stream_meta(dispatcher)
+        ingest = tenant.accumulator.run()
+
+    tasks = [mirror.run()] if mirror is not None else []
+
     try:
         await asyncio.gather(
-            client_streams.api_stream_requests(),
-            events.device_stream_event(),
-            tenant.stream_meta(),
-            run_periodically(update_device_status, device_int,
+            *tasks,
+            dispatcher.run(),
+            ingest,
+            run_periodically(client_keys.update_device_status, device_int,
                              'update_device_status'),
             run_periodically(client_keys.helium_skfs_update, skfs_int,
                              'helium_skfs_update'),
+            run_periodically(log_metrics, metrics_int, 'log_metrics'),
         )
     finally:
+        helium_channel.close()
+        await chirpstack.close()
         await db.close()
 
 
@@ -0,0 +1,107 @@
+"""Benchmark: route skfs as `to_dict()` dicts of hex strings vs compact `Skf` objects.
+
+Measures, per representation, the time to convert a `list_skfs` listing,
+the memory the converted listing and its session set hold together, and the time
+to turn every entry back into an update.
+
+Run from the repository root:
+    python benchmarks/skf_compact.py [entries ...]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+from protos.helium import iot_config  # noqa: E402
+from RouteSkf import Skf  # noqa: E402
+
+
+def listing(entries: int):
+    """`list_skfs` responses, made one at a time as the stream would yield them."""
+    salt = os.urandom(8).hex()
+    for i in range(entries):
+        yield iot_config.SkfV1(
+            route_id='3a9e0c9c-6c7e-4c2b-9a38-3b4cf8a7f5e1',
+            devaddr=0x48000000 + i,
+            session_key=f'{salt}{i:016x}',
+            max_copies=i % 4,
+        )
+
+
+def dict_skfs(entries: int) -> list[dict]:
+    all_skfs = []
+    for skfs in listing(entries):
+        device = skfs.to_dict()
+        device['devaddr'] = hex(device['devaddr'])[2:]
+        if 'maxCopies' not in device.keys():
+            device['maxCopies'] = 0
+        all_skfs.append(device)
+    return all_skfs
+
+
+def dict_sessions(skfs: list[dict]) -> set:
+    return {(d['devaddr'], d['sessionKey'], d['maxCopies']) for d in skfs}
+
+
+def dict_updates(sessions: set) -> list:
+    return [
+        iot_config.RouteSkfUpdateReqV1RouteSkfUpdateV1(
+            devaddr=int(dev_addr, 16), session_key=nws_key, action=iot_config.ActionV1.add, max_copies=max_copies,
+        ) for dev_addr, nws_key, max_copies in sessions
+    ]
+
+
+def compact_skfs(entries: int) -> list[Skf]:
+    return [Skf.from_proto(skf) for skf in listing(entries)]
+
+
+def compact_sessions(skfs: list[Skf]) -> set:
+    return set(skfs)
+
+
+def compact_updates(sessions: set) -> list:
+    return [skf.update(iot_config.ActionV1.add) for skf in sessions]
+
+
+def measure(convert, sessions, updates, entries: int) -> tuple[float, float, float]:
+    start = time.perf_counter()
+    skfs = convert(entries)
+    held = sessions(skfs)
+    convert_time = time.perf_counter() - start
+    start = time.perf_counter()
+    updates(held)
+    update_time = time.perf_counter() - start
+    del skfs, held
+
+    # traced separately, tracemalloc slows allocation down too much to time with it.
+    # the listing and its session set are both alive while the diff runs.
+    tracemalloc.start()
+    skfs = convert(entries)
+    held = sessions(skfs)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del skfs, held
+    return convert_time, memory / 2 ** 20, update_time
+
+
+def bench(entries: int):
+    start = time.perf_counter()
+    for _ in listing(entries):
+        pass
+    baseline = time.perf_counter() - start
+
+    results = {
+        'dict': measure(dict_skfs, dict_sessions, dict_updates, entries),
+        'Skf': measure(compact_skfs, compact_sessions, compact_updates, entries),
+    }
+    for name, (convert_time, memory, update_time) in results.items():
+        print(
+            f'{entries:>9} {name:5} convert {convert_time - baseline:6.2f}s | held {memory:7.1f}MB '
+            f'| {memory * 2 ** 20 / entries:5.0f}B/skf | to updates {update_time:6.2f}s'
+        )
+
+
+if __name__ == '__main__':
+    for entries in [int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000]:
+        bench(entries)
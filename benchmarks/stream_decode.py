@@ -0,0 +1,112 @@
+"""Microbenchmark: MessageToDict vs direct field access on the stream hot paths.
+
+Run from the repository root:
+    python benchmarks/stream_decode.py [iterations]
+"""
+import os
+import sys
+import timeit
+from math import ceil
+
+from google.protobuf.json_format import MessageToDict
+from chirpstack_api import gw, stream, integration
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+from StreamDecoder import decode_uplink_meta, decode_join_event, decode_api_request, is_device_change  # noqa: E402
+
+
+def sample_uplink_meta(gateways: int = 3) -> bytes:
+    pl = stream.meta_pb2.UplinkMeta(
+        dev_eui='0123456789abcdef',
+        phy_payload_byte_count=35,
+        mac_command_byte_count=0,
+        application_payload_byte_count=22,
+    )
+    pl.tx_info.frequency = 904_300_000
+    pl.tx_info.modulation.lora.bandwidth = 125_000
+    pl.tx_info.modulation.lora.spreading_factor = 7
+    for i in range(gateways):
+        pl.rx_info.append(gw.gw_pb2.UplinkRxInfo(
+            gateway_id=f'{i:016x}', uplink_id=i, rssi=-100 + i, snr=7.5, channel=2,
+            context=b'\x00' * 16, metadata={'region_config_id': 'us915_0'},
+        ))
+    return pl.SerializeToString()
+
+
+def sample_join_event() -> bytes:
+    pl = integration.integration_pb2.JoinEvent(dev_addr='00aabbcc')
+    pl.device_info.dev_eui = '0123456789abcdef'
+    pl.device_info.tenant_name = 'tenant'
+    pl.device_info.application_name = 'application'
+    pl.device_info.device_name = 'device'
+    pl.device_info.tags['site'] = 'north'
+    return pl.SerializeToString()
+
+
+def sample_api_request() -> bytes:
+    pl = stream.api_request_pb2.ApiRequestLog(
+        service='api.DeviceService',
+        method='Update',
+        metadata={'dev_eui': '0123456789abcdef', 'is_disabled': 'false'},
+    )
+    return pl.SerializeToString()
+
+
+def sample_ui_request() -> bytes:
+    """A request the api:stream:request pre-filter throws away."""
+    pl = stream.api_request_pb2.ApiRequestLog(
+        service='api.GatewayService',
+        method='List',
+        metadata={'tenant_id': '52f14cd4-c6f1-4fbd-8f87-4025e1d49242', 'limit': '10', 'offset': '0',
+                  'user_agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36', 'search': ''},
+    )
+    return pl.SerializeToString()
+
+
+def dict_uplink_meta(raw: bytes):
+    pl = stream.meta_pb2.UplinkMeta()
+    pl.ParseFromString(raw)
+    data = MessageToDict(pl)
+    byte_count = data.get('applicationPayloadByteCount', data.get('phyPayloadByteCount', 0))
+    return data['devEui'], len(data['rxInfo']), ceil(byte_count / 24)
+
+
+def dict_join_event(raw: bytes):
+    pl = integration.integration_pb2.JoinEvent()
+    pl.ParseFromString(raw)
+    return MessageToDict(pl)['deviceInfo']['devEui']
+
+
+def dict_api_request(raw: bytes):
+    pl = stream.api_request_pb2.ApiRequestLog()
+    pl.ParseFromString(raw)
+    req = MessageToDict(pl)
+    return req['service'], req['method'], req['metadata']
+
+
+def dict_is_device_change(raw: bytes) -> bool:
+    service, method, _ = dict_api_request(raw)
+    return service == 'api.DeviceService' and method in ('Create', 'Update', 'Delete')
+
+
+def direct_api_request(raw: bytes):
+    pl = decode_api_request(raw)
+    return pl.service, pl.method, dict(pl.metadata)
+
+
+def bench(name: str, before, after, raw: bytes, number: int):
+    assert before(raw) == after(raw), f'{name}: decoders disagree'
+    t_before = min(timeit.repeat(lambda: before(raw), number=number, repeat=5)) / number
+    t_after = min(timeit.repeat(lambda: after(raw), number=number, repeat=5)) / number
+    print(
+        f'{name:24} MessageToDict {t_before * 1e6:7.2f}us | direct {t_after * 1e6:7.2f}us '
+        f'| saved {(t_before - t_after) * 1e6:7.2f}us/msg ({t_before / t_after:.1f}x)'
+    )
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    bench('stream:meta', dict_uplink_meta, decode_uplink_meta, sample_uplink_meta(), number)
+    bench('device:stream:event', dict_join_event, decode_join_event, sample_join_event(), number)
+    bench('api:stream:request', dict_api_request, direct_api_request, sample_api_request(), number)
+    bench('api:stream:request (ui)', dict_is_device_change, is_device_change, sample_ui_request(), number)
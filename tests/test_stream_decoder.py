@@ -0,0 +1,89 @@
+"""Wire level fixtures for the decoders chirpstack ships no python protos for.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+from StreamDecoder import api_request_dev_eui, api_request_route, decode_device_session, is_device_change  # noqa: E402
+
+
+def varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def field(number: int, value) -> bytes:
+    if isinstance(value, bytes):
+        return varint(number << 3 | 2) + varint(len(value)) + value
+    return varint(number << 3) + varint(value)
+
+
+# internal.DeviceSession as chirpstack v4 stores it in device.device_session.
+NWK_S_ENC_KEY = bytes(range(16))
+APP_S_KEY = bytes(range(16, 32))
+DEVICE_SESSION = b''.join([
+    field(2, bytes.fromhex('48000a1b')),            # dev_addr
+    field(4, b'\xaa' * 16),                         # integrity key, skipped
+    field(5, b'\xbb' * 16),                         # integrity key, skipped
+    field(6, NWK_S_ENC_KEY),                        # nwk_s_enc_key
+    field(7, field(1, b'') + field(2, APP_S_KEY)),  # app_s_key envelope, kek_label + aes_key
+    field(8, 1234),                                 # f_cnt_up
+    field(9, 56),                                   # n_f_cnt_down
+    field(10, 789),                                 # a_f_cnt_down
+    field(11, 0x00ffffff),                          # later field, skipped
+])
+
+
+def test_decode_device_session():
+    assert decode_device_session(DEVICE_SESSION) == (
+        '48000a1b', NWK_S_ENC_KEY.hex(), APP_S_KEY.hex(), 1234, 56,
+    )
+
+
+def test_decode_device_session_without_activation():
+    assert decode_device_session(b'') == ('', '', '', 0, 0)
+
+
+# api.ApiRequestLog as chirpstack writes it to api:stream:request, service (1), method (2), metadata (3).
+def api_request(service: str, method: str, metadata: bytes = b'') -> bytes:
+    request = b''
+    if service:
+        request += field(1, service.encode())
+    if method:
+        request += field(2, method.encode())
+    return request + metadata
+
+
+DEV_EUI_METADATA = field(3, field(1, b'dev_eui') + field(2, b'0102030405060708'))
+
+
+def test_device_changes_accepted():
+    for method in ('Create', 'Update', 'Delete'):
+        request = api_request('api.DeviceService', method, DEV_EUI_METADATA)
+        assert api_request_route(request) == ('api.DeviceService', method)
+        assert is_device_change(request)
+        assert api_request_dev_eui(request) == '0102030405060708'
+
+
+def test_other_requests_rejected():
+    assert not is_device_change(api_request('api.TenantService', 'Create', DEV_EUI_METADATA))
+    assert not is_device_change(api_request('api.DeviceProfileService', 'Update'))
+    assert not is_device_change(api_request('api.DeviceService', 'FlushDevNonces', DEV_EUI_METADATA))
+    assert not is_device_change(api_request('api.DeviceService', '', DEV_EUI_METADATA))
+    assert not is_device_change(b'')
+
+
+def test_metadata_never_touched():
+    # a metadata field claiming more bytes than follow would fail any parse that reached it.
+    truncated = varint(3 << 3 | 2) + varint(1 << 20) + b'dev_eui'
+    assert is_device_change(api_request('api.DeviceService', 'Update', truncated))